@@ -1,15 +1,25 @@
 import streamlit as st
 import pandas as pd
 from streamlit_pdf_viewer import pdf_viewer
-from audit_engine import analyze_study, extract_text_from_pdf, extract_pico_criteria, mine_citations
+from audit_engine import analyze_study, extract_text_from_pdf, extract_pico_criteria, mine_citations, audit_to_record, get_client
+from importers import iter_records, SUPPORTED_TYPES
+from view_model import ResultsView
 import database as db
-import concurrent.futures
+import file_store
+import pdf_pages
+import os
 
-# Initialize Database
+# Initialize Database (migrations run once per process; a no-op on reruns)
 db.init_db()
 
 st.set_page_config(page_title="AI Evidence Synthesis", layout="wide", page_icon="🩺")
 
+try:
+    get_client()
+except Exception:
+    st.error("🚨 OpenAI API Key missing!")
+    st.stop()
+
 # --- CUSTOM CSS (PRESERVED) ---
 st.markdown("""
 <style>
@@ -38,15 +48,47 @@ if 'miner_selections' not in st.session_state: st.session_state.miner_selections
 # =========================================================
 # HELPER: PDF DISPLAY
 # =========================================================
-def display_pdf(uploaded_file, height=900):
-    try:
-        uploaded_file.seek(0)
-        bytes_data = uploaded_file.getvalue()
-        pdf_viewer(input=bytes_data, width=None, height=height, render_text=True)
+def spooled_pdf(uploaded_file):
+    # Hash and store each upload once per session, not on every rerun. The
+    # copy lives in the bounded page cache and is re-spooled if evicted.
+    cache = st.session_state.setdefault('spooled_pdfs', {})
+    key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, 'file_id', None))
+    if key not in cache or not os.path.exists(cache[key][1]):
+        cache[key] = pdf_pages.store_pdf(uploaded_file)
         uploaded_file.seek(0)
+    pdf_pages.touch(cache[key][1])
+    return cache[key]
+
+def display_pdf(uploaded_file, height=900, key="pdf"):
+    try:
+        viewer = st.radio("Viewer", ["Page view", "Full document (text layer)"], horizontal=True,
+                          key=f"{key}_viewer", label_visibility="collapsed")
+        if viewer == "Page view":
+            # Only the page on screen is rendered and sent; repeat views hit the tile cache
+            digest, path = spooled_pdf(uploaded_file)
+            n_pages = pdf_pages.page_count(path)
+            c_nav, c_info = st.columns([1, 3])
+            page = c_nav.number_input("Page", min_value=1, max_value=n_pages, value=1, key=f"{key}_page_{digest[:12]}")
+            c_info.caption(f"Page {page} of {n_pages}")
+            with st.container(height=height):
+                st.image(pdf_pages.render_page(path, digest, page - 1), use_container_width=True)
+        else:
+            uploaded_file.seek(0)
+            bytes_data = uploaded_file.getvalue()
+            pdf_viewer(input=bytes_data, width=None, height=height, render_text=True)
+            uploaded_file.seek(0)
     except Exception as e:
         st.error(f"Error displaying PDF: {e}")
 
+# =========================================================
+# HELPER: CACHED RESULTS VIEW
+# =========================================================
+@st.cache_resource(max_entries=8, show_spinner=False)
+def load_results_view(project_id, stage, data_version):
+    # data_version is bumped by the database on every results write, so a
+    # changed project simply misses the cache. The view is shared read-only.
+    return ResultsView(db.get_project_results(project_id, stage))
+
 # =========================================================
 # HELPER: SCORECARD (PRESERVED)
 # =========================================================
@@ -55,7 +97,7 @@ def render_full_result_view(row):
     override = row.get('Override_History', None)
     
     css_class = "dec-include" if decision == "INCLUDE" else "dec-exclude" if decision == "EXCLUDE" else "dec-unclear"
-    icon = "✅" if decision == "INCLUDE" else "⛔" if decision == "EXCLUDE" else "🤔"
+    icon = "✅" if decision == "INCLUDE" else "⛔" if decision == "EXCLUDE" else "⏳" if decision == db.PENDING else "🤔"
     
     st.markdown(f'<div class="decision-box {css_class}">{icon} {decision}</div>', unsafe_allow_html=True)
     
@@ -173,7 +215,7 @@ if st.session_state.step == 0 or st.session_state.project_id is None:
                 with st.container(border=True):
                     c1, c2, c3 = st.columns([3, 1, 1])
                     with c1: st.subheader(p['name'])
-                    with c2: st.caption("Active") 
+                    with c2: st.caption(f"Active · ID {p['id']}")
                     with c3:
                         if st.button("Open", key=f"load_{p['id']}", type="primary", use_container_width=True):
                             st.session_state.project_id = p['id']
@@ -196,6 +238,10 @@ if st.session_state.step == 0 or st.session_state.project_id is None:
 # =========================================================
 elif st.session_state.step == 1:
     st.title("🛠️ Step 1: Protocol Configuration")
+    cur_protocol = db.get_current_protocol(st.session_state.project_id)
+    if cur_protocol:
+        st.caption(f"Current protocol: v{cur_protocol['Version']}. Changing the criteria saves a new version; "
+                   "existing results are kept and can be re-screened incrementally from the Batch tab.")
     c1, c2 = st.columns([1, 1])
     with c1:
         with st.expander("📂 Import from File", expanded=True):
@@ -231,8 +277,11 @@ elif st.session_state.step == 1:
 # =========================================================
 elif st.session_state.step == 2:
     st.markdown(f"# Welcome to {st.session_state.project_name} 🩺")
-    l1_count = len(db.get_project_results(st.session_state.project_id, "results_level_1"))
-    l2_count = len(db.get_project_results(st.session_state.project_id, "results_level_2"))
+    counts = db.get_stage_counts(st.session_state.project_id)
+    l1_count = sum(counts.get("level_1", {}).values())
+    l2_pending = counts.get("level_2", {}).get(db.PENDING, 0)
+    l2_count = sum(counts.get("level_2", {}).values()) - l2_pending
+    promotable = db.count_promotable(st.session_state.project_id)
     
     c1, c2 = st.columns(2)
     with c1:
@@ -241,10 +290,14 @@ elif st.session_state.step == 2:
             st.metric("Studies Processed", l1_count)
             if st.button("Enter Level 1", type="primary", use_container_width=True):
                 st.session_state.workflow_mode = "level_1"; st.session_state.step = 3; st.rerun()
+            if promotable and st.button(f"⏩ Promote {promotable} INCLUDE(s) to Level 2", use_container_width=True):
+                n = db.promote_level_1_includes(st.session_state.project_id)
+                st.toast(f"Queued {n} studies for full-text review."); st.rerun()
     with c2:
         with st.container(border=True):
             st.markdown("### 📖 Level 2: Full Text Review")
             st.metric("Studies Processed", l2_count)
+            if l2_pending: st.caption(f"⏳ {l2_pending} promoted studies awaiting full text")
             if st.button("Enter Level 2", type="primary", use_container_width=True):
                 st.session_state.workflow_mode = "level_2"; st.session_state.step = 3; st.rerun()
 
@@ -254,58 +307,45 @@ elif st.session_state.step == 2:
 elif st.session_state.step == 3:
     mode = st.session_state.workflow_mode
     mode_title = "Level 1" if mode == "level_1" else "Level 2"
-    current_table = "results_level_1" if mode == "level_1" else "results_level_2"
+    protocol = db.get_current_protocol(st.session_state.project_id)
     
     c_head_1, c_head_2 = st.columns([3, 1])
     with c_head_1: st.title(f"{mode_title} Workspace")
     with c_head_2: st.caption(f"Project: {st.session_state.project_name}")
     
     def add_result_to_db(title, text, audit, source):
-        # DUPLICATE CHECKER
-        existing = db.get_project_results(st.session_state.project_id, current_table)
-        if any(r['Title'] == title for r in existing):
-            return "DUPLICATE"
-
-        data = {
-            "Title": title, "Abstract": text, "Decision": audit.ScreeningDecision, 
-            "Reason": audit.Reasoning_Summary, "Confidence": audit.Confidence_Score,
-            "P": audit.ReasoningLog.Population_Check, "I": audit.ReasoningLog.Intervention_Check,
-            "C": audit.ReasoningLog.Comparator_Check, "O": audit.ReasoningLog.Outcome_Check,
-            "S": audit.ReasoningLog.StudyDesign_Check, "E": audit.ReasoningLog.Exclusion_Check,
-            "P_Reas": audit.ReasoningLog.Population_Reason, "I_Reas": audit.ReasoningLog.Intervention_Reason,
-            "C_Reas": audit.ReasoningLog.Comparator_Reason, "O_Reas": audit.ReasoningLog.Outcome_Reason,
-            "S_Reas": audit.ReasoningLog.StudyDesign_Reason, "E_Reas": audit.ReasoningLog.Exclusion_Reason,
-            "Source": source, "Override_History": ""
-        }
-        return db.save_result(st.session_state.project_id, data, current_table)
-
-# --- FIX: ROBUST BATCH PROCESSOR ---
-    def process_one_batch_item(item, is_pdf, pico_data, stage_mode):
-        import io 
+        # Duplicate check happens inside the insert transaction
+        data = audit_to_record(title, text, audit, source)
+        return db.save_new_result(st.session_state.project_id, data, mode, protocol)
+
+    def queue_pdfs(files, targets):
+        # Streamed to temp files first, outside any transaction; they only move
+        # into the shared store once their job items are committed, so a worker
+        # cleaning up identical content can't delete a file a new item needs
+        spooled = [(f, *file_store.spool(f)) for f in files]
         try:
-            if is_pdf:
-                # Unpack the tuple (filename, bytes) we send from the main loop
-                fname, fbytes = item
-                # Create a fake file object for PyMuPDF
-                fake_file = io.BytesIO(fbytes)
-                text = extract_text_from_pdf(fake_file, strict_crop=True)
-                name = fname
-            else:
-                # SAFE COLUMN MAPPING for CSV
-                title_key = next((k for k in item.index if k.lower() in ['title', 'study title', 'name']), None)
-                abstract_key = next((k for k in item.index if k.lower() in ['abstract', 'summary', 'text', 'description']), None)
-                
-                if not title_key: title_key = item.index[0] 
-                if not abstract_key: abstract_key = item.index[1] if len(item.index) > 1 else title_key
-                
-                name = str(item[title_key])
-                text = f"{name}\n{str(item[abstract_key])}"
-                
-            res = analyze_study(text, pico_data, stage=stage_mode)
-            return name, text, res
-        except Exception as e:
-            # Return the error so we can see it in the UI
-            return "Error", f"Failed: {str(e)}", None
+            items = ((targets.get(f.name) or f.name, None, file_store.path_for(digest), "", "", "", None) for f, digest, _ in spooled)
+            return db.enqueue_job(st.session_state.project_id, mode, "Batch PDF", protocol, items,
+                                  before_release=lambda: [file_store.place(tmp, digest) for _, digest, tmp in spooled])
+        finally:
+            for _, _, tmp in spooled: file_store.remove(tmp)  # no-op once placed
+
+    @st.fragment(run_every=3)
+    def render_job_progress():
+        jobs = db.get_project_jobs(st.session_state.project_id, mode)
+        if not jobs:
+            st.caption("No batch jobs yet.")
+            return
+        for j in jobs:
+            finished = j['Done'] + j['Failed']
+            with st.container(border=True):
+                st.markdown(f"**Job #{j['ID']}** · {j['Source']} · {j['Status'].upper()}")
+                st.progress(finished / j['Total'] if j['Total'] else 1.0,
+                            text=f"{finished}/{j['Total']} screened ({j['Failed']} failed)")
+                if j['Failed']:
+                    with st.expander("Failures"):
+                        for name, err in db.get_job_errors(j['ID']):
+                            st.caption(f"⚠️ {name}: {err}")
 
     tabs_list = ["Screening", "Audit Records", "Dashboard"]
     if mode == "level_2": tabs_list.insert(1, "Meta-Miner")
@@ -333,14 +373,25 @@ elif st.session_state.step == 3:
                             txt = extract_text_from_pdf(f, strict_crop=True) if f.type=="application/pdf" else str(f.read(),"utf-8")
                         else: txt = ""; file_name = ""
 
-                if f_to_display: display_pdf(f_to_display)
+                    queued_title = None
+                    if mode == "level_2":
+                        pending = db.get_pending_studies(st.session_state.project_id, mode)
+                        if pending:
+                            guess = db.find_pending_study(st.session_state.project_id, mode, file_name) if file_name else None
+                            options = [None] + pending
+                            pick = st.selectbox("Promoted study (optional)", options,
+                                                index=options.index(tuple(guess)) if guess and tuple(guess) in options else 0,
+                                                format_func=lambda p: "— New study —" if p is None else p[1][:80])
+                            if pick: queued_title = pick[1]
+
+                if f_to_display: display_pdf(f_to_display, key="single_pdf")
             
             with c2:
                 st.subheader("🤖 AI Analysis")
                 if st.button("Run Screening", type="primary", use_container_width=True, disabled=not txt):
                     with st.spinner("Analyzing..."):
                         res = analyze_study(txt, st.session_state.pico, stage=mode)
-                        nid = add_result_to_db(ti if 'ti' in locals() and ti else file_name, txt, res, "Single")
+                        nid = add_result_to_db(queued_title or (ti if 'ti' in locals() and ti else file_name), txt, res, "Single")
                         
                         if nid == "DUPLICATE":
                             st.warning("⚠️ Study with this title already exists in the database.")
@@ -365,62 +416,52 @@ elif st.session_state.step == 3:
                     st.markdown("#### 🛠 Manual Override")
                     b1, b2 = st.columns(2)
                     if b1.button("Override -> INCLUDE", use_container_width=True, key="sing_ov_inc"):
-                         db.update_result_decision(st.session_state.last_audit_id, "INCLUDE", "Manual Override", current_table)
+                         db.update_result_decision(st.session_state.last_audit_id, "INCLUDE", "Manual Override", st.session_state.user)
                          st.session_state.last_single_result.ScreeningDecision = "INCLUDE"
                          st.rerun()
                     if b2.button("Override -> EXCLUDE", use_container_width=True, key="sing_ov_exc"):
-                         db.update_result_decision(st.session_state.last_audit_id, "EXCLUDE", "Manual Override", current_table)
+                         db.update_result_decision(st.session_state.last_audit_id, "EXCLUDE", "Manual Override", st.session_state.user)
                          st.session_state.last_single_result.ScreeningDecision = "EXCLUDE"
                          st.rerun()
 
         with st2:
-            st.info("⚡ Parallel Batch Processing (5x Speed)")
+            st.info("⚡ Batches run in the background worker (`python worker.py`). You can leave this page while they run.")
+            stale = db.count_stale_results(st.session_state.project_id, mode, protocol['Hash']) if protocol else 0
+            if stale:
+                st.warning(f"🔁 {stale} record(s) were screened against an older protocol (current: v{protocol['Version']}). "
+                           "Re-screening only re-runs these; manual overrides are kept.")
+                if st.button("Queue Re-screen of Stale Records"):
+                    jid = db.enqueue_rescreen(st.session_state.project_id, mode, protocol)
+                    if jid: st.success(f"Queued re-screen job #{jid}.")
+                    else: st.info("All stale records are already queued.")
             if mode == "level_1":
-                bf = st.file_uploader("Upload CSV", type=["csv"])
-                if bf and st.button("Run Batch"):
-                    df_upload = pd.read_csv(bf)
-                    bar = st.progress(0)
-                    rows = [r for _, r in df_upload.iterrows()]; total = len(rows)
-                    
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                        pico = st.session_state.pico; stg = mode
-                        futures = [executor.submit(process_one_batch_item, r, False, pico, stg) for r in rows]
-                        for i, f in enumerate(concurrent.futures.as_completed(futures)):
-                            name, text, res = f.result()
-                            if res: # Only add if valid result
-                                add_result_to_db(name, text, res, "Batch CSV")
-                            bar.progress((i + 1) / total)
-                    st.success("Done!")
+                bf = st.file_uploader("Upload search export (CSV, RIS, PubMed NBIB, EndNote XML)", type=SUPPORTED_TYPES)
+                if bf and st.button("Queue Batch"):
+                    try:
+                        items = ((r.title, r.screening_text(), None, r.doi, r.pmid, r.authors, r.year) for r in iter_records(bf, filename=bf.name))
+                        ext = os.path.splitext(bf.name)[1].lstrip(".").upper()
+                        jid = db.enqueue_job(st.session_state.project_id, mode, f"Batch {ext}", protocol, items)
+                        st.success(f"Queued job #{jid}.")
+                    except Exception as e:
+                        st.error(f"Could not import {bf.name}: {e}")
             else:
                 bfs = st.file_uploader("Upload PDFs", type=["pdf"], accept_multiple_files=True)
-                if bfs and st.button("Run Batch"):
-                    # 1. PRE-READ FILES
-                    pdf_data = [(f.name, f.read()) for f in bfs]
-                    
-                    bar = st.progress(0)
-                    total = len(pdf_data)
-                    success_count = 0
-                    
-                    # 2. SMART WORKER ALLOCATION
-                    # If Level 2 (Full Text), use 1 worker to save tokens. 
-                    # If Level 1 (Abstracts), use 4 workers for speed.
-                    workers = 1 if mode == "level_2" else 4
-                    st.toast(f"Processing with {workers} concurrent worker(s)...")
-
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-                        pico = st.session_state.pico; stg = mode
-                        futures = [executor.submit(process_one_batch_item, p_data, True, pico, stg) for p_data in pdf_data]
-                        
-                        for i, f in enumerate(concurrent.futures.as_completed(futures)):
-                            name, text, res = f.result()
-                            if res:
-                                add_result_to_db(name, text, res, "Batch PDF")
-                                success_count += 1
-                            else:
-                                st.error(f"⚠️ Failed: {name}")
-                            bar.progress((i + 1) / total)
-                            
-                    st.success(f"Batch Complete! Processed {success_count}/{total}.")
+                targets = {}
+                pending = db.get_pending_studies(st.session_state.project_id, mode) if bfs else []
+                if pending:
+                    # PDFs are named by file, not title: link each to its promoted study
+                    guesses = [db.find_pending_study(st.session_state.project_id, mode, f.name) for f in bfs]
+                    mapping = st.data_editor(
+                        pd.DataFrame({"PDF": [f.name for f in bfs], "Promoted study": [g[1] if g else None for g in guesses]}),
+                        column_config={"Promoted study": st.column_config.SelectboxColumn(options=[t for _, t in pending])},
+                        disabled=["PDF"], hide_index=True, use_container_width=True, key="batch_pending_map")
+                    targets = {f.name: t for f, t in zip(bfs, mapping["Promoted study"]) if isinstance(t, str) and t}
+                if bfs and st.button("Queue Batch"):
+                    jid = queue_pdfs(bfs, targets)
+                    st.success(f"Queued job #{jid} ({len(bfs)} PDFs).")
+
+            st.markdown("#### Batch Jobs")
+            render_job_progress()
 
     # --- TAB 2: META-MINER ---
     if mode == "level_2":
@@ -430,7 +471,7 @@ elif st.session_state.step == 3:
             with c1:
                 with st.expander("📂 Upload Systematic Review", expanded=True):
                     mf = st.file_uploader("Review PDF", type=["pdf"], label_visibility="collapsed")
-                if mf: display_pdf(mf, height=800)
+                if mf: display_pdf(mf, height=800, key="miner_pdf")
             
             with c2:
                 if mf and st.button("Extract Citations", type="primary", use_container_width=True):
@@ -468,93 +509,122 @@ elif st.session_state.step == 3:
                     st.divider()
                     if st.button("Add to Level 2 Screen Results", type="primary", use_container_width=True):
                         added_count = 0
-                        # Check dupes manually for this block
-                        existing = db.get_project_results(st.session_state.project_id, current_table)
-                        existing_titles = [r['Title'] for r in existing]
+                        # save_new_result skips studies already in this stage
 
                         if st.session_state.get("sel_meta", False):
-                             if curr_name not in existing_titles:
-                                 data = {"Title": curr_name, "Abstract": "Systematic Review Source File", "Decision": "INCLUDE", "Reason": "Mined Source", "Confidence": 100, "P":True,"I":True,"C":True,"O":True,"S":True,"E":False,"P_Reas":"","I_Reas":"","C_Reas":"","O_Reas":"","S_Reas":"","E_Reas":"","Source": f"Mined Source", "Override_History": ""}
-                                 db.save_result(st.session_state.project_id, data, current_table)
+                             data = {"Title": curr_name, "Abstract": "Systematic Review Source File", "Decision": "INCLUDE", "Reason": "Mined Source", "Confidence": 100, "P":True,"I":True,"C":True,"O":True,"S":True,"E":False,"P_Reas":"","I_Reas":"","C_Reas":"","O_Reas":"","S_Reas":"","E_Reas":"","Source": f"Mined Source", "Override_History": ""}
+                             if db.save_new_result(st.session_state.project_id, data, mode) != "DUPLICATE":
                                  added_count += 1
                         
                         for i, c in enumerate(res.Citations):
                             if st.session_state.miner_selections.get(i, False):
-                                if c.Title not in existing_titles:
-                                    data = {
-                                        "Title": c.Title, 
-                                        "Abstract": f"AUTHOR: {c.AuthorYear}\nCONTEXT: {c.Context}\nREASON: {c.Reason}", 
-                                        "Decision": "INCLUDE", 
-                                        "Reason": c.Reason, 
-                                        "Confidence": c.Confidence, 
-                                        "P":True,"I":True,"C":True,"O":True,"S":True,"E":False,
-                                        "P_Reas":"","I_Reas":"","C_Reas":"","O_Reas":"","S_Reas":"","E_Reas":"",
-                                        "Source": f"Mined: {curr_name}", 
-                                        "Override_History": ""
-                                    }
-                                    db.save_result(st.session_state.project_id, data, current_table)
+                                data = {
+                                    "Title": c.Title, 
+                                    "Abstract": f"AUTHOR: {c.AuthorYear}\nCONTEXT: {c.Context}\nREASON: {c.Reason}", 
+                                    "Decision": "INCLUDE", 
+                                    "Reason": c.Reason, 
+                                    "Confidence": c.Confidence, 
+                                    "P":True,"I":True,"C":True,"O":True,"S":True,"E":False,
+                                    "P_Reas":"","I_Reas":"","C_Reas":"","O_Reas":"","S_Reas":"","E_Reas":"",
+                                    "Source": f"Mined: {curr_name}", 
+                                    "Override_History": ""
+                                }
+                                if db.save_new_result(st.session_state.project_id, data, mode) != "DUPLICATE":
                                     added_count += 1
                         
                         st.success(f"Imported {added_count} studies! (Skipped duplicates)")
 
     # --- TAB 3: AUDIT RECORDS ---
+    vm = load_results_view(st.session_state.project_id, mode, db.get_data_version(st.session_state.project_id))
     idx = 2 if mode == "level_2" else 1
     with tabs[idx]:
         st.subheader("🗃️ Audit Records")
-        res = db.get_project_results(st.session_state.project_id, current_table)
-        df = pd.DataFrame(res)
-        if not df.empty:
-            
-            # --- FIX: VISUAL RE-INDEXING (1, 2, 3...) ---
-            df = df.sort_values(by='ID') # Ensure consistent order
-            df['Display_ID'] = range(1, len(df) + 1)
-            
+        if not vm.empty:
             c_fil, c_view = st.columns([1, 2])
             with c_fil:
-                dec = st.selectbox("Decision", ["All", "INCLUDE", "EXCLUDE", "UNCLEAR"])
-                src_list = ["All"] + list(df['Source'].unique()) if 'Source' in df.columns else ["All"]
-                src = st.selectbox("Source", src_list)
+                query, scope = "", "all"
+                if db.search_available():
+                    query = st.text_input("🔎 Search", placeholder="e.g. pediatric", help="Searches titles, abstracts and AI reasoning.")
+                    scope = st.radio("Search in", ["all", "reasoning", "title_abstract"], horizontal=True,
+                                     format_func={"all": "Everything", "reasoning": "AI reasoning", "title_abstract": "Title/abstract"}.get)
+                dec_options = ["All", "INCLUDE", "EXCLUDE", "UNCLEAR"] + ([db.PENDING] if mode == "level_2" else [])
+                dec = st.selectbox("Decision", dec_options)
+                src = st.selectbox("Source", vm.sources)
                 max_c = st.slider("Max Confidence (Find uncertain)", 0, 100, 100)
                 
-                vdf = df[df['Confidence'] <= max_c]
-                if dec != "All": vdf = vdf[vdf['Decision'] == dec]
-                if src != "All": vdf = vdf[vdf['Source'] == src]
+                visible_ids = vm.filter_ids(dec, src, max_c)
+                snippets = {}
+                if query:
+                    # Ranked by the FTS index, with the sidebar filters in the same query
+                    hits = db.search_results(st.session_state.project_id, mode, query, scope,
+                                             decision=None if dec == "All" else dec, max_confidence=max_c,
+                                             source=None if src == "All" else src)
+                    snippets = {rid: snip for rid, snip in hits if rid in vm.row_index}
+                    visible_ids = list(snippets)
+                    st.caption(f"{len(visible_ids)} match(es)")
                 
+                with st.expander(f"Bulk Override ({len(visible_ids)} shown)"):
+                    st.caption("Applies to every record matching the filters above (and the search, if any). "
+                               "Promoted studies still PENDING are skipped unless the Decision filter is PENDING.")
+                    bulk_dec = st.selectbox("Set decision to", ["EXCLUDE", "INCLUDE", "UNCLEAR"], key="bulk_dec")
+                    bulk_note = st.text_input("Note", value="Bulk Override", key="bulk_note")
+                    bulk_filters = dict(decision=None if dec == "All" else dec, max_confidence=max_c,
+                                        source=None if src == "All" else src, search=query or None, scope=scope)
+                    n_match = db.count_override_matches(st.session_state.project_id, mode, bulk_dec, **bulk_filters)
+                    st.warning(f"{n_match} record(s) will change to {bulk_dec}.")
+                    # Keyed on the scope, so changing a filter needs a fresh confirmation
+                    confirm_key = f"bulk_confirm_{bulk_dec}_{n_match}_{sorted(bulk_filters.items())}"
+                    confirmed = st.checkbox(f"I confirm overriding {n_match} record(s)", key=confirm_key)
+                    if st.button("Apply", use_container_width=True, disabled=not (confirmed and n_match)):
+                        changed = db.bulk_update_decision(
+                            st.session_state.project_id, mode, bulk_dec, bulk_note or "Bulk Override", st.session_state.user,
+                            **bulk_filters)
+                        st.session_state.pop(confirm_key, None)
+                        st.toast(f"Set {changed} record(s) to {bulk_dec}")
+                        st.rerun()
+
                 # Use Display_ID for the radio button label, but keep ID for logic
-                sel = st.radio("Select:", vdf['ID'], format_func=lambda x: f"#{vdf[vdf.ID==x]['Display_ID'].iloc[0]} {vdf[vdf.ID==x]['Title'].iloc[0][:30]}...")
+                sel = st.radio("Select:", visible_ids, format_func=vm.labels.get)
             
             with c_view:
-                if sel and not vdf.empty:
-                    row = df[df.ID == sel].iloc[0]
+                if sel and visible_ids:
+                    row = vm.row(sel)
                     # Show Display ID in Title
                     st.markdown(f"### #{row['Display_ID']}: {row['Title']}")
+                    if sel in snippets: st.markdown(f"> 🔎 {snippets[sel]}")
                     render_full_result_view(row)
+                    if pd.notna(row.get('Protocol_Version')):
+                        st.caption(f"Screened against protocol v{int(row['Protocol_Version'])}")
                     st.info(f"**AI Reason:** {row['Reason']}")
                     with st.expander("Full Text / Abstract", expanded=False): st.write(row['Abstract'])
                     
                     c_b1, c_b2 = st.columns(2)
-                    if c_b1.button("Override: INCLUDE", use_container_width=True): db.update_result_decision(int(row['ID']), "INCLUDE", "Manual Override", current_table); st.rerun()
-                    if c_b2.button("Override: EXCLUDE", use_container_width=True): db.update_result_decision(int(row['ID']), "EXCLUDE", "Manual Override", current_table); st.rerun()
+                    if c_b1.button("Override: INCLUDE", use_container_width=True): db.update_result_decision(int(row['ID']), "INCLUDE", "Manual Override", st.session_state.user); st.rerun()
+                    if c_b2.button("Override: EXCLUDE", use_container_width=True): db.update_result_decision(int(row['ID']), "EXCLUDE", "Manual Override", st.session_state.user); st.rerun()
+                    history = db.get_decision_history(int(row['ID']))
+                    if history:
+                        with st.expander(f"Decision History ({len(history)})"):
+                            st.dataframe(pd.DataFrame(history, columns=["When", "From", "To", "By", "Note"]), hide_index=True, use_container_width=True)
 
     # --- TAB 4: DASHBOARD ---
     idx = 3 if mode == "level_2" else 2
     with tabs[idx]:
         st.subheader("📊 Analytics")
-        if not df.empty:
-            total_studies = len(df)
+        if not vm.empty:
+            total_studies = vm.total
             m1, m2, m3, m4 = st.columns(4)
             m1.metric("Total Studies", total_studies)
-            m2.metric("Included", len(df[df['Decision']=='INCLUDE']))
-            m3.metric("Excluded", len(df[df['Decision']=='EXCLUDE']))
-            m4.metric("Unclear", len(df[df['Decision']=='UNCLEAR']))
+            m2.metric("Included", vm.decision_counts.get('INCLUDE', 0))
+            m3.metric("Excluded", vm.decision_counts.get('EXCLUDE', 0))
+            m4.metric("Unclear", vm.decision_counts.get('UNCLEAR', 0))
             st.divider()
             
-            ov_df = df[df['Override_History'] != ""]
-            ov_num = len(ov_df)
+            override_counts = db.get_override_stats(st.session_state.project_id, mode)
+            ov_num = sum(override_counts.values())
             ov_pct = round((ov_num / total_studies) * 100, 1) if total_studies > 0 else 0
             
-            ov_to_inc = len(ov_df[ov_df['Decision'] == 'INCLUDE'])
-            ov_to_exc = len(ov_df[ov_df['Decision'] == 'EXCLUDE'])
+            ov_to_inc = override_counts.get('INCLUDE', 0)
+            ov_to_exc = override_counts.get('EXCLUDE', 0)
             
             st.markdown("#### ⚠️ Override Analysis")
             o1, o2, o3, o4 = st.columns(4)
@@ -563,21 +633,27 @@ elif st.session_state.step == 3:
             o3.metric("Overridden → INCLUDE", f"{ov_to_inc}")
             o4.metric("Overridden → EXCLUDE", f"{ov_to_exc}")
             
+            if vm.metered_calls:
+                st.markdown("#### 🧮 Prompt Caching")
+                k1, k2, k3 = st.columns(3)
+                k1.metric("Metered Screening Calls", vm.metered_calls)
+                k2.metric("Prompt Tokens", f"{vm.prompt_tokens:,}")
+                k3.metric("Cached Share", f"{round(vm.cached_tokens / vm.prompt_tokens * 100, 1) if vm.prompt_tokens else 0}%")
+
+            if mode == "level_2":
+                st.divider()
+                st.markdown("#### 🔀 Level 1 → Level 2")
+                flow = pd.DataFrame(db.get_stage_transitions(st.session_state.project_id), columns=["Level 1", "Level 2", "Studies"])
+                if not flow.empty:
+                    st.dataframe(flow.pivot(index="Level 1", columns="Level 2", values="Studies").fillna(0).astype(int), use_container_width=True)
+
             st.divider()
             c1, c2 = st.columns(2)
             with c1:
                 st.markdown("#### Decisions by Source")
-                if 'Source' in df.columns:
-                    df['SourceType'] = df['Source'].apply(lambda x: "Mined" if "Mined" in str(x) else "Direct Upload")
-                    st.bar_chart(df.groupby("SourceType")['Decision'].value_counts().unstack())
+                st.bar_chart(vm.source_decisions)
             with c2:
                 st.markdown("#### Confidence Distribution")
-                import altair as alt
-                chart = alt.Chart(df).mark_bar().encode(
-                    alt.X("Confidence:Q", bin=True, title="Confidence Score"),
-                    alt.Y("count()", title="Number of Studies"),
-                    tooltip=["count()"]
-                ).interactive()
-                st.altair_chart(chart, use_container_width=True)
+                st.bar_chart(vm.confidence_hist)
             
-            st.download_button("Download Full Data CSV", df.to_csv().encode('utf-8'), "audit_data.csv")
\ No newline at end of file
+            st.download_button("Download Full Data CSV", vm.to_csv(), "audit_data.csv")
\ No newline at end of file
@@ -1,16 +1,32 @@
-import streamlit as st
+import functools
+import hashlib
+import json
+import os
+import threading
 import time 
 import fitz  # PyMuPDF
 from openai import OpenAI
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import Literal, List
+from database import effective_protocol
 
 # --- 1. CONNECT ---
-try:
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-except Exception:
-    st.error("🚨 OpenAI API Key missing!")
-    st.stop()
+# Built on first use rather than at import, so importing the engine (the app
+# on every rerun, the worker, the CLI) costs nothing until a call is made
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                api_key = os.environ.get("OPENAI_API_KEY")
+                if not api_key:
+                    import streamlit as st
+                    api_key = st.secrets["OPENAI_API_KEY"]
+                _client = OpenAI(api_key=api_key)
+    return _client
 
 # --- 2. DATA STRUCTURES ---
 class ProtocolStructure(BaseModel):
@@ -41,6 +57,8 @@ class ScreeningDecision(BaseModel):
     Confidence_Score: int
     Reasoning_Summary: str
     ReasoningLog: ReasoningLog
+    # Token usage reported by the API, not part of the response schema
+    _usage: dict = PrivateAttr(default_factory=dict)
 
 # --- UPDATED MINER MODELS ---
 class CitationItem(BaseModel):
@@ -63,26 +81,36 @@ class CitationList(BaseModel):
     Citations: List[CitationItem]
 
 # --- 3. OPTIMIZED PDF EXTRACTOR ---
-def extract_text_from_pdf(uploaded_file, strict_crop=True):
-    all_text = ""
+def read_pdf_text(uploaded_file, strict_crop=True):
+    # uploaded_file: a file object, or a path on disk. Paths are opened by
+    # PyMuPDF directly, so the PDF bytes are never copied into Python memory.
+    # Raises on unreadable files; the worker must not screen an error message.
+    parts = []
     stop_keywords = ["REFERENCES", "References", "BIBLIOGRAPHY", "Bibliography", "LITERATURE CITED"]
     
+    if isinstance(uploaded_file, str):
+        doc = fitz.open(uploaded_file, filetype="pdf")
+    else:
+        doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
+    with doc:
+        for page in doc:
+            text = page.get_text()
+            if strict_crop and any(k in text[:500] for k in stop_keywords):
+                parts.append("\n\n[...References Removed...]")
+                break 
+            parts.append(text + "\n")
+    return "".join(parts)
+
+def extract_text_from_pdf(uploaded_file, strict_crop=True):
     try:
-        with fitz.open(stream=uploaded_file.read(), filetype="pdf") as doc:
-            for page in doc:
-                text = page.get_text()
-                if strict_crop and any(k in text[:500] for k in stop_keywords):
-                    all_text += "\n\n[...References Removed...]"
-                    break 
-                all_text += text + "\n"
+        return read_pdf_text(uploaded_file, strict_crop)
     except Exception as e:
         return f"Error reading PDF: {e}"
-    return all_text
 
 # --- 4. EXTRACT PICO ---
 def extract_pico_criteria(protocol_text):
     system_prompt = "You are a Methodologist. Extract strict PICO criteria."
-    completion = client.beta.chat.completions.parse(
+    completion = get_client().beta.chat.completions.parse(
         model="gpt-4o-2024-08-06",
         messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": protocol_text[:15000]}],
         response_format=ProtocolStructure,
@@ -91,22 +119,49 @@ def extract_pico_criteria(protocol_text):
     return completion.choices[0].message.parsed
 
 # --- 5. ANALYZE STUDY ---
-def analyze_study(text_content, pico_criteria, stage="level_1"):
+# The provider caches prompts by exact prefix, so everything fixed for a
+# protocol and stage goes first, byte-identical on every call, and the study
+# text goes last
+SCREENING_PROMPT = (
+    "You are a Cochrane Screener.\n"
+    "CRITERIA: P: {P}, I: {I}, C: {C}, O: {O}, S: {S}, E: {E}\n"
+    "Allow Meta-Analysis? {IncludeMetaAnalysis}"
+)
+
+@functools.lru_cache(maxsize=64)
+def _compile_screening_request(criteria_json, stage):
     model_choice = "gpt-4o-mini" if stage == "level_1" else "gpt-4o-2024-08-06"
     # Level 2 uses more context, Level 1 is tighter
-    max_chars = 15000 if stage == "level_1" else 100000 
+    max_chars = 15000 if stage == "level_1" else 100000
+    criteria = json.loads(criteria_json)
+    system_prompt = SCREENING_PROMPT.format(**criteria)
+    # Routes calls sharing this prefix to the same cache
+    cache_key = f"{stage}-{hashlib.sha256(system_prompt.encode()).hexdigest()[:16]}"
+    return model_choice, max_chars, system_prompt, cache_key
 
-    system_prompt = f"""
-    You are a Cochrane Screener.
-    CRITERIA: P: {pico_criteria['P']}, I: {pico_criteria['I']}, C: {pico_criteria['C']}, O: {pico_criteria['O']}, S: {pico_criteria['S']}, E: {pico_criteria['E']}
-    Allow Meta-Analysis? {pico_criteria.get('IncludeMetaAnalysis', False)}
-    """
+def compile_screening_request(pico_criteria, stage="level_1"):
+    # Same normalisation as the protocol hash, so edits that don't create a
+    # new protocol version don't change the prompt either
+    return _compile_screening_request(json.dumps(effective_protocol(pico_criteria), sort_keys=True), stage)
+
+def usage_of(completion):
+    usage = getattr(completion, "usage", None)
+    if usage is None: return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {"prompt_tokens": usage.prompt_tokens,
+            "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0}
+
+def analyze_study(text_content, pico_criteria, stage="level_1", rate_limit_placeholder=True):
+    # rate_limit_placeholder=False (worker, CLI): a rate limit that outlasts the
+    # retries raises, so the item fails and can be retried, instead of being
+    # saved as a real UNCLEAR result
+    model_choice, max_chars, system_prompt, cache_key = compile_screening_request(pico_criteria, stage)
 
     # RETRY LOGIC (Max 3 attempts)
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            completion = client.beta.chat.completions.parse(
+            completion = get_client().beta.chat.completions.parse(
                 model=model_choice,
                 messages=[
                     {"role": "system", "content": system_prompt}, 
@@ -114,9 +169,11 @@ def analyze_study(text_content, pico_criteria, stage="level_1"):
                 ],
                 response_format=ScreeningDecision,
                 temperature=0.0,
+                extra_body={"prompt_cache_key": cache_key},
             )
             
             result = completion.choices[0].message.parsed
+            result._usage = usage_of(completion)
             
             # Confidence Check
             if result.Confidence_Score < 85:
@@ -133,6 +190,8 @@ def analyze_study(text_content, pico_criteria, stage="level_1"):
                     wait_time = 35 # Wait 35 seconds (slightly more than the 30.36s requested)
                     time.sleep(wait_time)
                     continue # Try again
+                elif not rate_limit_placeholder:
+                    raise
                 else:
                     # If we fail 3 times, return a dummy Fail object
                     return ScreeningDecision(
@@ -170,7 +229,7 @@ def mine_citations(text_content, pico_criteria):
     """
     
     # 1. AI DOES THE EXTRACTION
-    completion = client.beta.chat.completions.parse(
+    completion = get_client().beta.chat.completions.parse(
         model="gpt-4o-mini", # Fast enough for list extraction
         messages=[
             {"role": "system", "content": system_prompt},
@@ -209,4 +268,22 @@ def mine_citations(text_content, pico_criteria):
             
         final_list.append(ref)
         
-    return CitationList(Citations=final_list)
\ No newline at end of file
+    return CitationList(Citations=final_list)
+
+# --- 7. RESULT RECORD (shared by the UI and the background worker) ---
+def audit_to_record(title, text, audit, source, doi="", pmid="", authors="", year=None):
+    log = audit.ReasoningLog
+    return {
+        "Title": title, "Abstract": text, "Decision": audit.ScreeningDecision,
+        "Reason": audit.Reasoning_Summary, "Confidence": audit.Confidence_Score,
+        "P": log.Population_Check, "I": log.Intervention_Check,
+        "C": log.Comparator_Check, "O": log.Outcome_Check,
+        "S": log.StudyDesign_Check, "E": log.Exclusion_Check,
+        "P_Reas": log.Population_Reason, "I_Reas": log.Intervention_Reason,
+        "C_Reas": log.Comparator_Reason, "O_Reas": log.Outcome_Reason,
+        "S_Reas": log.StudyDesign_Reason, "E_Reas": log.Exclusion_Reason,
+        "Source": source, "Override_History": "",
+        "Prompt_Tokens": audit._usage.get("prompt_tokens"),
+        "Cached_Tokens": audit._usage.get("cached_tokens"),
+        "DOI": doi, "PMID": pmid, "Authors": authors, "Year": year
+    }
@@ -0,0 +1,123 @@
+"""Headless batch screening, e.g. from cron:
+
+    python cli.py --project 3 --stage level_1 --records search_export.ris
+    python cli.py --project 3 --stage level_2 --pdf-dir ./fulltexts
+    python cli.py --project 3 --stage level_1 --rescreen
+
+Input is streamed (record-by-record import, lazy directory walk) and only a bounded
+number of studies are in flight, so memory stays flat however big the
+input is. Results go straight into the project's results table.
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+import database as db
+from importers import iter_records
+from worker import screen_and_save, set_max_open_pdfs
+
+def iter_pdf_dir(root, project_id=None, stage=None):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if fn.lower().endswith(".pdf"):
+                # A PDF of a promoted study fills in its PENDING row
+                pending = db.find_pending_study(project_id, stage, fn) if project_id else None
+                # Named by path under root: main.pdf in two folders is two studies
+                path = os.path.join(dirpath, fn)
+                yield pending[1] if pending else os.path.relpath(path, root), None, path, None, "", "", "", None
+
+
+class Progress:
+    def __init__(self, every=1.0):
+        self.started = time.time()
+        self.last = 0.0
+        self.every = every
+        self.done = self.failed = self.skipped = 0
+
+    def show(self, in_flight, force=False):
+        now = time.time()
+        if not force and now - self.last < self.every: return
+        self.last = now
+        rate = self.done / max(now - self.started, 1e-9)
+        sys.stderr.write(f"\r{self.done} screened | {self.skipped} skipped | {self.failed} failed | "
+                         f"{rate:.2f} studies/s | {in_flight} in flight   ")
+        sys.stderr.flush()
+
+
+def run(project_id, stage, items, source, concurrency=4, max_in_flight=None, max_open_pdfs=2):
+    db.init_db()
+    set_max_open_pdfs(max_open_pdfs)
+    if not db.get_project(project_id):
+        raise SystemExit(f"Project {project_id} not found.")
+    protocol = db.get_current_protocol(project_id)
+    if not protocol:
+        raise SystemExit(f"Project {project_id} has no protocol yet. Configure it in the app first.")
+
+    max_in_flight = max_in_flight or concurrency * 2
+    progress = Progress()
+    in_flight = {}
+
+    def drain(block_until):
+        while len(in_flight) > block_until:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                name = in_flight.pop(f)
+                try:
+                    if f.result() in ("DUPLICATE", "FRESH"): progress.skipped += 1
+                    else: progress.done += 1
+                except Exception as e:
+                    progress.failed += 1
+                    sys.stderr.write(f"\nFailed: {name}: {e}\n")
+            progress.show(len(in_flight))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for name, text, path, result_id, doi, pmid, authors, year in items:
+            # Skip known, unchanged studies before paying for an API call. PDFs
+            # are checked by screen_and_save once their text has been read.
+            if not result_id and not path and db.result_exists(project_id, name, stage, doi, pmid, text):
+                progress.skipped += 1
+                continue
+            in_flight[executor.submit(screen_and_save, project_id, stage, protocol,
+                                      name, text, path, source, result_id, doi, pmid, authors, year)] = name
+            drain(max_in_flight - 1)
+        drain(0)
+
+    progress.show(0, force=True)
+    sys.stderr.write("\n")
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Screen a CSV export or a directory of PDFs without the web app.")
+    parser.add_argument("--project", type=int, required=True, help="Project ID (see the Project Library).")
+    parser.add_argument("--stage", choices=["level_1", "level_2"], default="level_1")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--records", "--csv", dest="records", help="Search export: CSV, RIS, PubMed NBIB or EndNote XML.")
+    src.add_argument("--pdf-dir", help="Directory searched recursively for PDFs.")
+    src.add_argument("--rescreen", action="store_true", help="Re-screen results made under an older protocol version.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel API calls.")
+    parser.add_argument("--max-open-pdfs", type=int, default=2, help="PDFs opened for text extraction at once.")
+    args = parser.parse_args()
+
+    if args.records:
+        ext = os.path.splitext(args.records)[1].lstrip(".").upper() or "Import"
+        items = ((r.title, r.screening_text(), None, None, r.doi, r.pmid, r.authors, r.year) for r in iter_records(args.records))
+        source = f"Batch {ext}"
+    elif args.rescreen:
+        db.init_db()
+        protocol = db.get_current_protocol(args.project)
+        if not protocol: raise SystemExit(f"Project {args.project} has no protocol yet.")
+        stale = db.iter_stale_results(args.project, args.stage, protocol['Hash'])
+        items, source = ((title, None, None, rid, "", "", "", None) for rid, title in stale), None
+    else:
+        db.init_db()
+        items, source = iter_pdf_dir(args.pdf_dir, args.project, args.stage), "Batch PDF"
+
+    result = run(args.project, args.stage, items, source, concurrency=args.concurrency,
+                 max_open_pdfs=args.max_open_pdfs)
+    if args.records and not (result.done or result.skipped or result.failed):
+        raise SystemExit(f"No records found in {args.records}.")
+    sys.exit(1 if result.failed and not result.done else 0)
@@ -1,13 +1,103 @@
 import sqlite3
 import json
 import hashlib
+import itertools
+import os
+import re
+import threading
 
 DB_NAME = "audit_app.db"
+STALE_CLAIM_SECONDS = 900  # running items older than this are handed back to the queue
+ENQUEUE_CHUNK = 500  # job items staged per committed write
+PROTOCOL_KEYS = ["P", "I", "C", "O", "S", "E"]  # the criteria analyze_study puts in the prompt
+PENDING = "PENDING"  # promoted to a stage but not screened there yet
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # UPDATED: Added 'email' column
+FTS_COLUMNS = ["title", "abstract", "reason", "p_reas", "i_reas", "c_reas", "o_reas", "s_reas", "e_reas"]
+SEARCH_SCOPES = {
+    "all": FTS_COLUMNS,
+    "title_abstract": ["title", "abstract"],
+    "reasoning": ["reason", "p_reas", "i_reas", "c_reas", "o_reas", "s_reas", "e_reas"],
+}
+
+RESULT_COLUMNS = [
+    "title", "abstract", "decision", "reason", "confidence",
+    "p_check", "i_check", "c_check", "o_check", "s_check", "e_check",
+    "p_reas", "i_reas", "c_reas", "o_reas", "s_reas", "e_reas",
+    "source", "override_history",
+    "protocol_version", "protocol_hash", "text_hash",
+    "prompt_tokens", "cached_tokens",
+    "doi", "pmid", "authors", "year",
+]
+
+def get_connection():
+    # Generous timeout: the UI and several worker processes write to the same file
+    return sqlite3.connect(DB_NAME, timeout=30)
+
+def table_columns(c, table):
+    return {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+
+def add_missing_columns(c, table, columns):
+    # CREATE TABLE IF NOT EXISTS won't touch an existing table, so new columns
+    # have to be added to older databases by hand
+    existing = table_columns(c, table)
+    for name, decl in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+def study_key(title):
+    # Case, punctuation and spacing differ between exports of the same study
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", (title or "").lower()).split())
+
+def doi_key(doi):
+    # DOIs are case-insensitive and often exported as URLs
+    return re.sub(r"^(https?://(dx\.)?doi\.org/|doi:\s*)", "", (doi or "").strip().lower())
+
+def migrate_legacy_results(c):
+    # Older databases kept one table per stage. Fold them into `results`:
+    # Level 1 keeps its IDs, Level 2 IDs are shifted past them (queued
+    # re-screen items are shifted the same way)
+    legacy = [r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('results_level_1', 'results_level_2') ORDER BY name")]
+    if not legacy:
+        return
+    c.connection.create_function("study_key", 1, study_key, deterministic=True)
+    # Only the columns `results` has at this point in the migration sequence
+    existing = table_columns(c, "results")
+    cols = ", ".join(col for col in ["project_id"] + RESULT_COLUMNS if col in existing)
+    for table in legacy:
+        stage = table.replace("results_", "")
+        add_missing_columns(c, table, [("protocol_version", "INTEGER"), ("protocol_hash", "TEXT"), ("text_hash", "TEXT")])
+        offset = c.execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0]
+        c.execute(f"INSERT INTO results (id, stage, study_key, {cols}) SELECT id + ?, ?, study_key(title), {cols} FROM {table}",
+                  (offset, stage))
+        c.execute("UPDATE job_items SET result_id = result_id + ? WHERE result_id IS NOT NULL AND job_id IN (SELECT id FROM screening_jobs WHERE stage=?)",
+                  (offset, stage))
+        c.execute(f"DROP TABLE {table}")
+
+def create_search_index(c):
+    # External-content FTS5 index over the results text, kept in sync by
+    # triggers. Decision-only updates don't touch it.
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='results_fts'").fetchall()
+    cols = ", ".join(FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{col}" for col in FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{col}" for col in FTS_COLUMNS)
+    try:
+        c.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS results_fts USING fts5({cols}, content='results', content_rowid='id', tokenize='porter unicode61')")
+    except sqlite3.OperationalError:
+        return  # SQLite built without FTS5: search is simply unavailable
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS results_fts_insert AFTER INSERT ON results BEGIN
+                     INSERT INTO results_fts (rowid, {cols}) VALUES (new.id, {new_cols}); END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS results_fts_delete AFTER DELETE ON results BEGIN
+                     INSERT INTO results_fts (results_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS results_fts_update AFTER UPDATE OF {cols} ON results BEGIN
+                     INSERT INTO results_fts (results_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                     INSERT INTO results_fts (rowid, {cols}) VALUES (new.id, {new_cols}); END''')
+    if not exists:
+        c.execute("INSERT INTO results_fts (results_fts) VALUES ('rebuild')")
+
+def migrate_001_baseline(c):
+    # Everything up to the introduction of user_version. Written to be
+    # idempotent, because databases at version 0 may have been created by
+    # any earlier init_db() and be missing any subset of it.
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (username TEXT PRIMARY KEY, email TEXT, password TEXT)''')
     
@@ -16,35 +106,159 @@ def init_db():
                   user_id TEXT, name TEXT, pico_data TEXT, 
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    # RE-ADDED: The separate Level 1 / Level 2 tables
-    c.execute('''CREATE TABLE IF NOT EXISTS results_level_1
+    # One results table for both stages. study_key identifies the same study
+    # at Level 1 and Level 2, so cross-stage questions are a single query
+    c.execute('''CREATE TABLE IF NOT EXISTS results
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  project_id INTEGER,
+                  project_id INTEGER, stage TEXT NOT NULL, study_key TEXT,
                   title TEXT, abstract TEXT, 
                   decision TEXT, reason TEXT, confidence INTEGER,
                   p_check BOOLEAN, i_check BOOLEAN, c_check BOOLEAN, 
                   o_check BOOLEAN, s_check BOOLEAN, e_check BOOLEAN,
                   p_reas TEXT, i_reas TEXT, c_reas TEXT, 
                   o_reas TEXT, s_reas TEXT, e_reas TEXT,
-                  source TEXT, override_history TEXT)''')
+                  source TEXT, override_history TEXT,
+                  protocol_version INTEGER, protocol_hash TEXT, text_hash TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_results_decision ON results (project_id, stage, decision)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_results_study ON results (project_id, stage, study_key)")
 
-    c.execute('''CREATE TABLE IF NOT EXISTS results_level_2
+    # Background screening: one job per uploaded batch, one item per study
+    c.execute('''CREATE TABLE IF NOT EXISTS screening_jobs
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  project_id INTEGER,
-                  title TEXT, abstract TEXT, 
-                  decision TEXT, reason TEXT, confidence INTEGER,
-                  p_check BOOLEAN, i_check BOOLEAN, c_check BOOLEAN, 
-                  o_check BOOLEAN, s_check BOOLEAN, e_check BOOLEAN,
-                  p_reas TEXT, i_reas TEXT, c_reas TEXT, 
-                  o_reas TEXT, s_reas TEXT, e_reas TEXT,
-                  source TEXT, override_history TEXT)''')
+                  project_id INTEGER, stage TEXT, source TEXT, pico_data TEXT,
+                  status TEXT DEFAULT 'queued',
+                  total INTEGER DEFAULT 0, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
 
-    conn.commit()
-    conn.close()
+    c.execute('''CREATE TABLE IF NOT EXISTS job_items
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  job_id INTEGER, name TEXT, text TEXT, file_path TEXT,
+                  status TEXT DEFAULT 'queued', worker_id TEXT, error TEXT,
+                  claimed_at TIMESTAMP)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_job_items_status ON job_items (status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_job_items_file ON job_items (file_path)")
+
+    # Protocol history: a new version is stored whenever the effective criteria change
+    c.execute('''CREATE TABLE IF NOT EXISTS protocol_versions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  project_id INTEGER, version INTEGER, pico_data TEXT, pico_hash TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  UNIQUE (project_id, version))''')
+
+    add_missing_columns(c, "screening_jobs", [("protocol_version", "INTEGER"), ("protocol_hash", "TEXT")])
+    add_missing_columns(c, "projects", [("data_version", "INTEGER DEFAULT 0")])
+    add_missing_columns(c, "job_items", [("result_id", "INTEGER")])
+
+    migrate_legacy_results(c)
+
+    # Any write to a project's results bumps its data_version, which is what
+    # the UI's cached views are keyed on
+    for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS results_version_{event.lower()} AFTER {event} ON results
+                     BEGIN UPDATE projects SET data_version = COALESCE(data_version, 0) + 1 WHERE id = {ref}.project_id; END''')
+
+    create_search_index(c)
+
+def migrate_002_job_item_result_index(c):
+    # Re-screen enqueueing skips results that unfinished items already cover
+    c.execute("CREATE INDEX IF NOT EXISTS idx_job_items_result ON job_items (result_id)")
+
+def migrate_003_token_usage(c):
+    # Prompt and provider-cached token counts per screening call
+    c.execute("ALTER TABLE results ADD COLUMN prompt_tokens INTEGER")
+    c.execute("ALTER TABLE results ADD COLUMN cached_tokens INTEGER")
+
+def migrate_004_decision_events(c):
+    # Append-only audit trail of decision changes. override_history on the
+    # result only marks it as overridden; the history lives here.
+    c.execute('''CREATE TABLE IF NOT EXISTS decision_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  result_id INTEGER NOT NULL, project_id INTEGER, stage TEXT,
+                  old_decision TEXT, new_decision TEXT, actor TEXT, note TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_decision_events_result ON decision_events (result_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_decision_events_project ON decision_events (project_id, stage, result_id)")
+    for event in ("UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS decision_events_no_{event.lower()} BEFORE {event} ON decision_events
+                     BEGIN SELECT RAISE(ABORT, 'decision_events is append-only'); END''')
+    # Overrides made before the table existed: the earlier decision is unknown
+    c.execute('''INSERT INTO decision_events (result_id, project_id, stage, new_decision, note)
+                 SELECT id, project_id, stage, decision, override_history FROM results
+                 WHERE COALESCE(override_history, '') != '' ORDER BY id''')
+
+def migrate_005_job_items_job_index(c):
+    # Job totals, releases and error lists all look items up by job
+    c.execute("CREATE INDEX IF NOT EXISTS idx_job_items_job ON job_items (job_id, status)")
+
+def migrate_006_identifiers(c):
+    # DOI/PMID from search exports, so the same study is recognised even when
+    # its title differs between sources
+    for table in ("results", "job_items"):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN doi TEXT DEFAULT ''")
+        c.execute(f"ALTER TABLE {table} ADD COLUMN pmid TEXT DEFAULT ''")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_results_doi ON results (project_id, stage, doi)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_results_pmid ON results (project_id, stage, pmid)")
+
+def migrate_007_citation_fields(c):
+    # The rest of the imported citation, kept alongside the identifiers
+    for table in ("results", "job_items"):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN authors TEXT DEFAULT ''")
+        c.execute(f"ALTER TABLE {table} ADD COLUMN year INTEGER")
+
+# --- MIGRATIONS ---
+# Append only. The schema version stored in PRAGMA user_version is the
+# number of migrations applied, so never reorder or edit a shipped entry.
+MIGRATIONS = [
+    migrate_001_baseline,
+    migrate_002_job_item_result_index,
+    migrate_003_token_usage,
+    migrate_004_decision_events,
+    migrate_005_job_items_job_index,
+    migrate_006_identifiers,
+    migrate_007_citation_fields,
+]
+
+_initialized = set()  # DB files already migrated by this process
+_init_lock = threading.Lock()
+
+def migrate(conn):
+    conn.isolation_level = None
+    c = conn.cursor()
+    # WAL lets the UI read progress while workers are writing. Must be set
+    # outside a transaction, so it goes first.
+    c.execute("PRAGMA journal_mode=WAL").fetchall()
+    if c.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+    # Another process may be migrating too: take the write lock, then re-read
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            step(c)
+            c.execute(f"PRAGMA user_version = {number}")
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+
+def init_db():
+    # Runs the pending migrations once per process; later calls (e.g. every
+    # Streamlit rerun) return immediately
+    if DB_NAME in _initialized:
+        return
+    with _init_lock:
+        if DB_NAME in _initialized:
+            return
+        conn = get_connection()
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+        _initialized.add(DB_NAME)
 
 # --- USER FUNCTIONS (Updated) ---
 def create_user(username, email, password):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     hashed_pw = hashlib.sha256(password.encode()).hexdigest()
     try:
@@ -58,7 +272,7 @@ def create_user(username, email, password):
         conn.close()
 
 def login_user(username, password):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     hashed_pw = hashlib.sha256(password.encode()).hexdigest()
     # We don't check email for login, just username/pass
@@ -69,17 +283,18 @@ def login_user(username, password):
 
 # --- PROJECT FUNCTIONS ---
 def create_project(user_id, name, pico_dict):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("INSERT INTO projects (user_id, name, pico_data) VALUES (?, ?, ?)", 
               (user_id, name, json.dumps(pico_dict)))
     pid = c.lastrowid
+    if pico_dict: record_protocol_version(c, pid, pico_dict)
     conn.commit()
     conn.close()
     return pid
 
 def get_user_projects(user_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT id, name, pico_data FROM projects WHERE user_id=?", (user_id,))
     projects = []
@@ -88,68 +303,676 @@ def get_user_projects(user_id):
     conn.close()
     return projects
 
+def get_project(project_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, name, pico_data FROM projects WHERE id=?", (project_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row: return None
+    return {"id": row[0], "name": row[1], "pico": json.loads(row[2])}
+
 def update_project_pico(project_id, pico_dict):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("UPDATE projects SET pico_data=? WHERE id=?", (json.dumps(pico_dict), project_id))
+    version = record_protocol_version(c, project_id, pico_dict) if pico_dict else None
     conn.commit()
     conn.close()
+    return version
+
+def get_data_version(project_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(data_version, 0) FROM projects WHERE id=?", (project_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+# --- PROTOCOL VERSIONS ---
+def effective_protocol(pico_dict):
+    # The criteria as screening sees them. Whitespace-insensitive, so re-saving
+    # the form without real edits changes neither the version nor the prompt.
+    effective = {k: " ".join(str(pico_dict.get(k) or "").split()) for k in PROTOCOL_KEYS}
+    effective["IncludeMetaAnalysis"] = bool(pico_dict.get("IncludeMetaAnalysis", False))
+    return effective
+
+def protocol_hash(pico_dict):
+    return hashlib.sha256(json.dumps(effective_protocol(pico_dict), sort_keys=True).encode()).hexdigest()
+
+def text_hash(text):
+    return hashlib.sha256((text or "").encode()).hexdigest()
+
+def record_protocol_version(c, project_id, pico_dict):
+    # Returns the current version number, adding a new one only if the criteria changed
+    c.execute("SELECT version, pico_hash FROM protocol_versions WHERE project_id=? ORDER BY version DESC LIMIT 1", (project_id,))
+    row = c.fetchone()
+    h = protocol_hash(pico_dict)
+    if row and row[1] == h:
+        return row[0]
+    version = (row[0] if row else 0) + 1
+    c.execute("INSERT OR IGNORE INTO protocol_versions (project_id, version, pico_data, pico_hash) VALUES (?, ?, ?, ?)",
+              (project_id, version, json.dumps(pico_dict), h))
+    return version
+
+def get_current_protocol(project_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT version, pico_data, pico_hash FROM protocol_versions WHERE project_id=? ORDER BY version DESC LIMIT 1", (project_id,))
+    row = c.fetchone()
+    if not row:
+        # Projects saved before versioning existed: their criteria become version 1
+        c.execute("SELECT pico_data FROM projects WHERE id=?", (project_id,))
+        p = c.fetchone()
+        pico = json.loads(p[0]) if p and p[0] else {}
+        if pico:
+            record_protocol_version(c, project_id, pico)
+            conn.commit()
+            row = (1, p[0], protocol_hash(pico))
+    conn.close()
+    if not row: return None
+    return {"Version": row[0], "Pico": json.loads(row[1]), "Hash": row[2]}
 
 # --- RESULT FUNCTIONS (Stage-Aware) ---
-def save_result(project_id, data, stage_table):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    query = f'''INSERT INTO {stage_table} (
-        project_id, title, abstract, decision, reason, confidence,
-        p_check, i_check, c_check, o_check, s_check, e_check,
-        p_reas, i_reas, c_reas, o_reas, s_reas, e_reas,
-        source, override_history
-    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
-    
-    c.execute(query, (
-        project_id, data['Title'], data['Abstract'], data['Decision'], data['Reason'], data['Confidence'],
+def result_values(data, protocol):
+    # In RESULT_COLUMNS order
+    return (
+        data['Title'], data['Abstract'], data['Decision'], data['Reason'], data['Confidence'],
         data['P'], data['I'], data['C'], data['O'], data['S'], data['E'],
         data['P_Reas'], data['I_Reas'], data['C_Reas'], data['O_Reas'], data['S_Reas'], data['E_Reas'],
-        data['Source'], data['Override_History']
-    ))
-    new_id = c.lastrowid
+        data['Source'], data['Override_History'],
+        protocol['Version'] if protocol else None, protocol['Hash'] if protocol else None,
+        text_hash(data['Abstract']),
+        data.get('Prompt_Tokens'), data.get('Cached_Tokens'),
+        doi_key(data.get('DOI')), (data.get('PMID') or "").strip(),
+        data.get('Authors') or "", data.get('Year')
+    )
+
+def insert_result(c, project_id, data, stage, protocol=None):
+    marks = ",".join("?" * (len(RESULT_COLUMNS) + 3))
+    c.execute(f"INSERT INTO results (project_id, stage, study_key, {', '.join(RESULT_COLUMNS)}) VALUES ({marks})",
+              (project_id, stage, study_key(data['Title'])) + result_values(data, protocol))
+    return c.lastrowid
+
+def save_result(project_id, data, stage, protocol=None):
+    conn = get_connection()
+    c = conn.cursor()
+    new_id = insert_result(c, project_id, data, stage, protocol)
     conn.commit()
     conn.close()
     return new_id
 
-def get_project_results(project_id, stage_table):
-    conn = sqlite3.connect(DB_NAME)
+def same_study(doi, pmid, key, row=""):
+    # SQL for "row holds the same study as doi/pmid/key" (SQL expressions).
+    # Identifiers decide first: a shared DOI or PMID is the same study, and a
+    # conflicting one is a different study whatever the title. The title only
+    # decides when a side has no identifier to compare.
+    return f"""(({doi} != '' AND {row}doi = {doi}) OR ({pmid} != '' AND {row}pmid = {pmid})
+        OR ({row}study_key = {key}
+            AND ({doi} = '' OR COALESCE({row}doi, '') = '' OR {row}doi = {doi})
+            AND ({pmid} = '' OR COALESCE({row}pmid, '') = '' OR {row}pmid = {pmid})))"""
+
+SAME_STUDY = same_study("?", "?", "?")
+
+def same_study_params(title, doi="", pmid=""):
+    # In SAME_STUDY placeholder order
+    doi, pmid = doi_key(doi), (pmid or "").strip()
+    return (doi, doi, pmid, pmid, study_key(title), doi, doi, pmid, pmid)
+
+def result_exists(project_id, title, stage, doi="", pmid="", text=None):
+    # Promoted-but-unscreened studies don't count: they still need screening.
+    # With text given, a study whose text has changed doesn't count either.
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"""SELECT 1 FROM results WHERE project_id=? AND stage=? AND {SAME_STUDY} AND decision != ?
+                  AND (? IS NULL OR text_hash = ?) LIMIT 1""",
+              (project_id, stage) + same_study_params(title, doi, pmid) + (PENDING,) + (text_hash(text) if text is not None else None,) * 2)
+    found = c.fetchone() is not None
+    conn.close()
+    return found
+
+def save_new_result(project_id, data, stage, protocol=None):
+    # Duplicate check and insert in one write transaction, so parallel workers
+    # can't both insert the same study. A PENDING row for the study (promoted
+    # from Level 1) is filled in rather than duplicated. A screened study
+    # re-imported with different text takes the new screening in place, but
+    # only when a DOI/PMID proves it is the same study: a title-only match
+    # with different text (a second "Reply", another main.pdf) is a new row.
+    doi, pmid = doi_key(data.get('DOI')), (data.get('PMID') or "").strip()
+    new_hash = text_hash(data['Abstract'])
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(f"""SELECT id, decision, text_hash, (? != '' AND doi = ?) OR (? != '' AND pmid = ?)
+                      FROM results WHERE project_id=? AND stage=? AND {SAME_STUDY} ORDER BY id""",
+                  (doi, doi, pmid, pmid, project_id, stage) + same_study_params(data['Title'], doi, pmid))
+        rows = c.fetchall()
+        screened = [r for r in rows if r[1] != PENDING]
+        pending = [r for r in rows if r[1] == PENDING]
+        proven = [r for r in screened if r[3]]
+        if any(r[2] == new_hash for r in screened) or (screened and protocol is None):
+            c.execute("ROLLBACK")
+            return "DUPLICATE"
+        if proven:
+            new_id = proven[0][0]
+            refresh_screening(c, new_id, data, protocol, note="Re-import")
+        elif pending:
+            # The promoted row keeps its Level 1 title (PDFs arrive named by
+            # file) and any identifiers the screen didn't bring
+            new_id = pending[0][0]
+            values = dict(zip(RESULT_COLUMNS, result_values(data, protocol)))
+            kept = ("doi", "pmid", "authors", "year")
+            fill = [col for col in RESULT_COLUMNS if col != "title" and col not in kept]
+            c.execute(f"""UPDATE results SET {', '.join(f'{col}=?' for col in fill)},
+                          {', '.join(f"{col}=COALESCE(NULLIF(?, ''), {col})" for col in kept)} WHERE id=?""",
+                      [values[col] for col in fill] + [values[col] for col in kept] + [new_id])
+        else:
+            new_id = insert_result(c, project_id, data, stage, protocol)
+        c.execute("COMMIT")
+        return new_id
+    except Exception:
+        if conn.in_transaction: c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def refresh_screening(c, result_id, data, protocol, note="Re-screen"):
+    # Re-screen in place: text, AI fields and provenance are refreshed, but a
+    # manually overridden decision is kept. A changed decision is logged in
+    # the same transaction as the update.
+    c.execute('''INSERT INTO decision_events (result_id, project_id, stage, old_decision, new_decision, actor, note)
+                 SELECT id, project_id, stage, decision, ?, 'rescreen', ? FROM results
+                 WHERE id=? AND COALESCE(override_history, '') = '' AND decision != ?''',
+              (data['Decision'], note, result_id, data['Decision']))
+    c.execute('''UPDATE results SET
+        decision=CASE WHEN COALESCE(override_history, '') = '' THEN ? ELSE decision END,
+        abstract=?, reason=?, confidence=?,
+        p_check=?, i_check=?, c_check=?, o_check=?, s_check=?, e_check=?,
+        p_reas=?, i_reas=?, c_reas=?, o_reas=?, s_reas=?, e_reas=?,
+        protocol_version=?, protocol_hash=?, text_hash=?,
+        prompt_tokens=?, cached_tokens=?
+        WHERE id=?''', (
+        data['Decision'], data['Abstract'], data['Reason'], data['Confidence'],
+        data['P'], data['I'], data['C'], data['O'], data['S'], data['E'],
+        data['P_Reas'], data['I_Reas'], data['C_Reas'], data['O_Reas'], data['S_Reas'], data['E_Reas'],
+        protocol['Version'], protocol['Hash'], text_hash(data['Abstract']),
+        data.get('Prompt_Tokens'), data.get('Cached_Tokens'),
+        result_id
+    ))
+
+def update_result_screening(result_id, data, protocol):
+    conn = get_connection()
+    c = conn.cursor()
+    refresh_screening(c, result_id, data, protocol)
+    conn.commit()
+    conn.close()
+
+def row_to_result(row):
+    return {
+        "ID": row['id'],
+        "Stage": row['stage'],
+        "Title": row['title'],
+        "Abstract": row['abstract'],
+        "Decision": row['decision'],
+        "Reason": row['reason'],
+        "Confidence": row['confidence'],
+        "P": bool(row['p_check']), "I": bool(row['i_check']), 
+        "C": bool(row['c_check']), "O": bool(row['o_check']), 
+        "S": bool(row['s_check']), "E": bool(row['e_check']),
+        "P_Reas": row['p_reas'], "I_Reas": row['i_reas'], 
+        "C_Reas": row['c_reas'], "O_Reas": row['o_reas'], 
+        "S_Reas": row['s_reas'], "E_Reas": row['e_reas'],
+        "Source": row['source'],
+        "Override_History": row['override_history'],
+        "Protocol_Version": row['protocol_version'],
+        "Prompt_Tokens": row['prompt_tokens'],
+        "Cached_Tokens": row['cached_tokens'],
+        "DOI": row['doi'],
+        "PMID": row['pmid'],
+        "Authors": row['authors'],
+        "Year": row['year']
+    }
+
+def get_result(result_id):
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
-    query = f"SELECT * FROM {stage_table} WHERE project_id=?"
-    c.execute(query, (project_id,))
+    c.execute("SELECT * FROM results WHERE id=?", (result_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row: return None
+    result = row_to_result(row)
+    result.update({"Protocol_Hash": row['protocol_hash'], "Text_Hash": row['text_hash']})
+    return result
+
+def results_filter(project_id, stage, decision=None, max_confidence=None, source=None, alias=""):
+    # The Audit Records filters as SQL; alias qualifies columns in joins
+    clauses = [f"{alias}project_id=?", f"{alias}stage=?"]
+    params = [project_id, stage]
+    if decision:
+        clauses.append(f"{alias}decision=?"); params.append(decision)
+    if max_confidence is not None:
+        clauses.append(f"COALESCE({alias}confidence, 0) <= ?"); params.append(max_confidence)
+    if source:
+        clauses.append(f"{alias}source=?"); params.append(source)
+    return " AND ".join(clauses), params
+
+def get_project_results(project_id, stage):
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM results WHERE project_id=? AND stage=?", (project_id, stage))
     rows = c.fetchall()
     conn.close()
     
-    results = []
-    for row in rows:
-        results.append({
-            "ID": row['id'],
-            "Title": row['title'],
-            "Abstract": row['abstract'],
-            "Decision": row['decision'],
-            "Reason": row['reason'],
-            "Confidence": row['confidence'],
-            "P": bool(row['p_check']), "I": bool(row['i_check']), 
-            "C": bool(row['c_check']), "O": bool(row['o_check']), 
-            "S": bool(row['s_check']), "E": bool(row['e_check']),
-            "P_Reas": row['p_reas'], "I_Reas": row['i_reas'], 
-            "C_Reas": row['c_reas'], "O_Reas": row['o_reas'], 
-            "S_Reas": row['s_reas'], "E_Reas": row['e_reas'],
-            "Source": row['source'],
-            "Override_History": row['override_history']
-        })
-    return results
-
-def update_result_decision(result_id, new_decision, override_note, stage_table):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    query = f"UPDATE {stage_table} SET decision=?, override_history=? WHERE id=?"
-    c.execute(query, (new_decision, override_note, result_id))
+    return [row_to_result(row) for row in rows]
+
+# --- DECISION OVERRIDES ---
+def override_filter(project_id, stage, new_decision, decision=None, max_confidence=None, source=None,
+                    query=None, ids=None, include_pending=False):
+    # Rows that already have the new decision are left alone (no event), and
+    # promoted studies still awaiting their screen only when asked for
+    where, params = results_filter(project_id, stage, decision, max_confidence, source)
+    clauses = [where, "decision != ?"]
+    params.append(new_decision)
+    if not include_pending and decision != PENDING:
+        clauses.append("decision != ?"); params.append(PENDING)
+    if query:
+        # The whole search, not the page of hits on screen
+        clauses.append("id IN (SELECT rowid FROM results_fts WHERE results_fts MATCH ?)"); params.append(query)
+    if ids is not None:
+        clauses.append(f"id IN ({','.join('?' * len(ids))})"); params.extend(ids)
+    return " AND ".join(clauses), params
+
+def override_scope(project_id, stage, new_decision, decision=None, max_confidence=None, source=None,
+                   search=None, scope="all", ids=None, include_pending=False):
+    # override_filter for a free-text search; None when nothing can match
+    query = fts_query(search, scope) if search else None
+    if (ids is not None and not ids) or (search and not (query and search_available())):
+        return None
+    return override_filter(project_id, stage, new_decision, decision, max_confidence, source,
+                           query, ids, include_pending)
+
+def count_override_matches(project_id, stage, new_decision, decision=None, max_confidence=None, source=None,
+                           search=None, scope="all"):
+    # How many rows bulk_update_decision would change, for confirmation
+    found = override_scope(project_id, stage, new_decision, decision, max_confidence, source, search, scope)
+    if found is None: return 0
+    where, params = found
+    conn = get_connection()
+    count = conn.execute(f"SELECT COUNT(*) FROM results WHERE {where}", params).fetchone()[0]
+    conn.close()
+    return count
+
+def bulk_update_decision(project_id, stage, new_decision, note, actor=None, decision=None, max_confidence=None,
+                         source=None, search=None, scope="all", ids=None, include_pending=False):
+    # e.g. "exclude every UNCLEAR under 40% confidence from source X": one
+    # transaction that logs an event per row, then updates the same rows
+    found = override_scope(project_id, stage, new_decision, decision, max_confidence, source,
+                           search, scope, ids, include_pending)
+    if found is None: return 0
+    where, params = found
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(f'''INSERT INTO decision_events (result_id, project_id, stage, old_decision, new_decision, actor, note)
+                      SELECT id, project_id, stage, decision, ?, ?, ? FROM results WHERE {where} ORDER BY id''',
+                  [new_decision, actor, note] + params)
+        c.execute(f"UPDATE results SET decision=?, override_history=? WHERE {where}", [new_decision, note] + params)
+        changed = c.rowcount
+        c.execute("COMMIT")
+        return changed
+    except Exception:
+        if conn.in_transaction: c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def update_result_decision(result_id, new_decision, override_note, actor=None):
+    conn = get_connection()
+    row = conn.execute("SELECT project_id, stage FROM results WHERE id=?", (result_id,)).fetchone()
+    conn.close()
+    if not row: return 0
+    return bulk_update_decision(row[0], row[1], new_decision, override_note, actor, ids=[result_id], include_pending=True)
+
+def get_decision_history(result_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''SELECT created_at, old_decision, new_decision, actor, note FROM decision_events
+                 WHERE result_id=? ORDER BY id''', (result_id,))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_override_stats(project_id, stage):
+    # Current decision of every result with at least one override event
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''SELECT decision, COUNT(*) FROM results
+                 WHERE id IN (SELECT result_id FROM decision_events WHERE project_id=? AND stage=?)
+                 GROUP BY decision''', (project_id, stage))
+    counts = dict(c.fetchall())
+    conn.close()
+    return counts
+
+# --- FULL-TEXT SEARCH ---
+def fts_query(text, scope="all"):
+    # Free text -> safe FTS5 query: every word must match (as a prefix), and
+    # quotes/operators typed by the user can't cause a syntax error
+    words = re.findall(r"\w+", text or "")
+    if not words: return None
+    query = " AND ".join(f'"{w}" *' for w in words)
+    return f"{{{' '.join(SEARCH_SCOPES[scope])}}} : ({query})"
+
+def search_available():
+    # False when SQLite was built without FTS5 (see create_search_index)
+    conn = get_connection()
+    found = conn.execute("SELECT 1 FROM sqlite_master WHERE name='results_fts'").fetchone() is not None
+    conn.close()
+    return found
+
+def search_results(project_id, stage, text, scope="all", decision=None, max_confidence=None, source=None, limit=None):
+    # Ranked (bm25) matches with a highlighted snippet from the best column.
+    # Filters are applied in the same query, so a limit never hides matches
+    # that pass them.
+    query = fts_query(text, scope)
+    if not query or not search_available(): return []
+    where, params = results_filter(project_id, stage, decision, max_confidence, source, alias="r.")
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f'''SELECT r.id, snippet(results_fts, -1, '**', '**', '…', 16)
+                  FROM results_fts JOIN results r ON r.id = results_fts.rowid
+                  WHERE results_fts MATCH ? AND {where}
+                  ORDER BY bm25(results_fts) LIMIT ?''', [query] + params + [-1 if limit is None else limit])
+    hits = c.fetchall()
+    conn.close()
+    return hits
+
+# --- CROSS-STAGE ---
+PROMOTABLE = f'''FROM results r
+    WHERE r.project_id=? AND r.stage='level_1' AND r.decision='INCLUDE'
+      AND NOT EXISTS (SELECT 1 FROM results l2
+                      WHERE l2.project_id=r.project_id AND l2.stage='level_2'
+                        AND {same_study("COALESCE(r.doi, '')", "COALESCE(r.pmid, '')", "r.study_key", "l2.")})'''
+# Level 1 rows of one study (a title shared by different DOIs/PMIDs is not one study)
+PROMOTED_STUDY = "r.study_key, COALESCE(r.doi, ''), COALESCE(r.pmid, '')"
+
+def count_promotable(project_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT COUNT(*) FROM (SELECT 1 {PROMOTABLE} GROUP BY {PROMOTED_STUDY})", (project_id,))
+    n = c.fetchone()[0]
+    conn.close()
+    return n
+
+def promote_level_1_includes(project_id):
+    # One statement: every Level 1 INCLUDE not yet at Level 2 becomes a PENDING
+    # Level 2 row that a full-text screen of the same study will fill in
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f'''INSERT INTO results (project_id, stage, study_key, title, abstract, decision, reason,
+                                        confidence, source, override_history, doi, pmid, authors, year)
+                  SELECT r.project_id, 'level_2', r.study_key, r.title, r.abstract, ?,
+                         'Included at Level 1, awaiting full-text review.', 0, 'Promoted: Level 1', '',
+                         COALESCE(r.doi, ''), COALESCE(r.pmid, ''), MAX(r.authors), MAX(r.year)
+                  {PROMOTABLE}
+                  GROUP BY {PROMOTED_STUDY}''', (PENDING, project_id))
+    n = c.rowcount
+    conn.commit()
+    conn.close()
+    return n
+
+def find_pending_study(project_id, stage, file_name):
+    # Full texts are usually named by title, PMID or DOI (with '/' swapped
+    # for '_'): find the promoted study a PDF belongs to, if any
+    stem = os.path.splitext(os.path.basename(file_name or ""))[0]
+    pmid = stem if stem.isdigit() else ""
+    doi = doi_key(stem.replace("_", "/", 1)) if stem.startswith("10.") else ""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT id, title FROM results WHERE project_id=? AND stage=? AND decision=? AND {SAME_STUDY} ORDER BY id LIMIT 1",
+              (project_id, stage, PENDING) + same_study_params(stem, doi, pmid))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def get_pending_studies(project_id, stage):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, title FROM results WHERE project_id=? AND stage=? AND decision=? ORDER BY id",
+              (project_id, stage, PENDING))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_stage_counts(project_id):
+    # {stage: {decision: count}} from the decision index alone
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT stage, decision, COUNT(*) FROM results WHERE project_id=? GROUP BY stage, decision", (project_id,))
+    counts = {}
+    for stage, decision, n in c.fetchall():
+        counts.setdefault(stage, {})[decision] = n
+    conn.close()
+    return counts
+
+def get_stage_transitions(project_id):
+    # How Level 1 decisions fared at Level 2, e.g. (INCLUDE, EXCLUDE, 12)
+    conn = get_connection()
+    c = conn.cursor()
+    # Same identity rule as promotion, and one Level 2 decision per Level 1
+    # row (a screened one in preference to PENDING)
+    c.execute(f'''SELECT l1.decision,
+                        COALESCE((SELECT l2.decision FROM results l2
+                                  WHERE l2.project_id=l1.project_id AND l2.stage='level_2'
+                                    AND {same_study("COALESCE(l1.doi, '')", "COALESCE(l1.pmid, '')", "l1.study_key", "l2.")}
+                                  ORDER BY l2.decision = ?, l2.id LIMIT 1), 'NOT AT LEVEL 2'),
+                        COUNT(*)
+                 FROM results l1
+                 WHERE l1.project_id=? AND l1.stage='level_1'
+                 GROUP BY 1, 2''', (PENDING, project_id))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+# --- INCREMENTAL RE-SCREENING ---
+# Mined citations were never AI screened and PENDING rows have nothing to refresh yet
+STALE_FILTER = f"""project_id=? AND stage=? AND COALESCE(protocol_hash, '') != ?
+    AND decision != '{PENDING}' AND COALESCE(source, '') NOT LIKE 'Mined%'"""
+
+def count_stale_results(project_id, stage, current_hash):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT COUNT(*) FROM results WHERE {STALE_FILTER}", (project_id, stage, current_hash))
+    n = c.fetchone()[0]
+    conn.close()
+    return n
+
+def iter_stale_results(project_id, stage, current_hash, page_size=500):
+    # Keyset pages, so huge projects never load all IDs at once
+    last_id = 0
+    while True:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute(f"SELECT id, title FROM results WHERE {STALE_FILTER} AND id > ? ORDER BY id LIMIT ?",
+                  (project_id, stage, current_hash, last_id, page_size))
+        page = c.fetchall()
+        conn.close()
+        if not page: return
+        for rid, title in page:
+            yield rid, title
+        last_id = page[-1][0]
+
+# --- SCREENING JOB FUNCTIONS ---
+def insert_job(c, project_id, stage, source, protocol, status="queued"):
+    # The protocol is snapshotted so edits made mid-run don't mix criteria within a job
+    protocol = protocol or {"Version": None, "Pico": {}, "Hash": None}
+    c.execute("INSERT INTO screening_jobs (project_id, stage, source, pico_data, protocol_version, protocol_hash, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (project_id, stage, source, json.dumps(protocol['Pico']), protocol['Version'], protocol['Hash'], status))
+    return c.lastrowid
+
+def enqueue_job(project_id, stage, source, protocol, items, before_release=None):
+    # items: iterable of (name, text, file_path, doi, pmid, authors, year) tuples, possibly a generator
+    # straight off an importer. It is only ever advanced between transactions:
+    # items are staged in short committed chunks, so the write lock is never
+    # held while input is parsed or spooled. Workers see nothing until the
+    # whole job is released; if anything fails the staged job is deleted.
+    conn = get_connection()
+    c = conn.cursor()
+    job_id = insert_job(c, project_id, stage, source, protocol, status="loading")
+    conn.commit()
+    try:
+        items = iter(items)
+        while True:
+            chunk = [(job_id, name, text, path, doi_key(doi), (pmid or "").strip(), authors or "", year)
+                     for name, text, path, doi, pmid, authors, year in itertools.islice(items, ENQUEUE_CHUNK)]
+            if not chunk: break
+            c.executemany("INSERT INTO job_items (job_id, name, text, file_path, doi, pmid, authors, year, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'staged')", chunk)
+            conn.commit()
+        if before_release: before_release()
+        c.execute("UPDATE job_items SET status='queued' WHERE job_id=? AND status='staged'", (job_id,))
+        if not c.rowcount:
+            raise ValueError("No records found to screen.")
+        c.execute("UPDATE screening_jobs SET status='queued', total=? WHERE id=?", (c.rowcount, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        c.execute("DELETE FROM job_items WHERE job_id=?", (job_id,))
+        c.execute("DELETE FROM screening_jobs WHERE id=?", (job_id,))
+        conn.commit()
+        raise
+    finally:
+        conn.close()
+    return job_id
+
+def enqueue_rescreen(project_id, stage, protocol):
+    # Set-based: stale rows go straight from the results table into the queue,
+    # skipping any that an unfinished job is already re-screening
+    conn = get_connection()
+    c = conn.cursor()
+    job_id = insert_job(c, project_id, stage, "Re-screen", protocol)
+    c.execute(f'''INSERT INTO job_items (job_id, name, result_id)
+                  SELECT ?, title, id FROM results
+                  WHERE {STALE_FILTER}
+                    AND id NOT IN (SELECT i.result_id FROM job_items i
+                                   WHERE i.result_id IS NOT NULL AND i.status IN ('queued', 'running'))''',
+              (job_id, project_id, stage, protocol['Hash']))
+    total = c.rowcount
+    if total:
+        c.execute("UPDATE screening_jobs SET total=? WHERE id=?", (total, job_id))
+        conn.commit()
+    else:
+        conn.rollback()
+        job_id = None
+    conn.close()
+    return job_id
+
+def claim_job_items(worker_id, limit):
+    # BEGIN IMMEDIATE takes the write lock before we look, so two workers
+    # never claim the same item
+    conn = get_connection()
+    conn.isolation_level = None
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT id FROM job_items WHERE status='queued' ORDER BY id LIMIT ?", (limit,))
+        ids = [r['id'] for r in c.fetchall()]
+        if ids:
+            marks = ",".join("?" * len(ids))
+            c.execute(f"UPDATE job_items SET status='running', worker_id=?, claimed_at=CURRENT_TIMESTAMP WHERE id IN ({marks})",
+                      [worker_id] + ids)
+            c.execute(f"UPDATE screening_jobs SET status='running' WHERE status='queued' AND id IN (SELECT job_id FROM job_items WHERE id IN ({marks}))",
+                      ids)
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction: c.execute("ROLLBACK")
+        conn.close()
+        raise
+
+    items = []
+    if ids:
+        c.execute(f'''SELECT i.id, i.job_id, i.name, i.text, i.file_path, i.result_id, i.doi, i.pmid, i.authors, i.year,
+                             j.project_id, j.stage, j.source, j.pico_data, j.protocol_version, j.protocol_hash
+                      FROM job_items i JOIN screening_jobs j ON j.id = i.job_id
+                      WHERE i.id IN ({marks}) ORDER BY i.id''', ids)
+        for row in c.fetchall():
+            items.append({
+                "ID": row['id'], "Job_ID": row['job_id'],
+                "Name": row['name'], "Text": row['text'], "File_Path": row['file_path'],
+                "Result_ID": row['result_id'], "DOI": row['doi'], "PMID": row['pmid'],
+                "Authors": row['authors'], "Year": row['year'],
+                "Project_ID": row['project_id'], "Stage": row['stage'], "Source": row['source'],
+                "Protocol": {"Version": row['protocol_version'], "Pico": json.loads(row['pico_data']),
+                             "Hash": row['protocol_hash']}
+            })
+    conn.close()
+    return items
+
+def finish_job_item(item_id, error=None):
+    conn = get_connection()
+    c = conn.cursor()
+    status = "failed" if error else "done"
+    counter = "failed" if error else "done"
+    c.execute("UPDATE job_items SET status=?, error=? WHERE id=? AND status='running'", (status, error, item_id))
+    if c.rowcount:
+        c.execute(f'''UPDATE screening_jobs SET {counter}={counter}+1,
+                     status=CASE WHEN done+failed+1 >= total THEN 'done' ELSE status END
+                     WHERE id=(SELECT job_id FROM job_items WHERE id=?)''', (item_id,))
+    conn.commit()
+    conn.close()
+
+def remove_file_if_unused(file_path, except_item_id, remove):
+    # Spooled PDFs are content-addressed, so items of several jobs can share a
+    # file. Checked and removed under the write lock: enqueue_job commits its
+    # items before the uploads are moved into place, so a new item is either
+    # seen here or its file arrives after this removal.
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT 1 FROM job_items WHERE file_path=? AND id != ? AND status IN ('staged', 'queued', 'running') LIMIT 1",
+                  (file_path, except_item_id))
+        if c.fetchone() is None:
+            remove(file_path)
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction: c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def requeue_stale_items(max_age_seconds=STALE_CLAIM_SECONDS):
+    # Hand items held by a crashed worker back to the queue
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("UPDATE job_items SET status='queued', worker_id=NULL WHERE status='running' AND claimed_at < datetime('now', ?)",
+              (f"-{int(max_age_seconds)} seconds",))
+    n = c.rowcount
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+    return n
+
+def get_project_jobs(project_id, stage, limit=10):
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('''SELECT id, source, status, total, done, failed, created_at FROM screening_jobs
+                 WHERE project_id=? AND stage=? ORDER BY id DESC LIMIT ?''', (project_id, stage, limit))
+    jobs = [{"ID": r['id'], "Source": r['source'], "Status": r['status'], "Total": r['total'],
+             "Done": r['done'], "Failed": r['failed'], "Created_At": r['created_at']} for r in c.fetchall()]
+    conn.close()
+    return jobs
+
+def get_job_errors(job_id, limit=20):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT name, error FROM job_items WHERE job_id=? AND status='failed' ORDER BY id LIMIT ?", (job_id, limit))
+    errors = c.fetchall()
+    conn.close()
+    return errors
@@ -0,0 +1,58 @@
+"""Content-addressed on-disk store for uploaded PDFs.
+
+Uploads are streamed to disk in fixed-size chunks while being hashed, so
+spooling a batch never holds more than one chunk in memory. Identical
+files map to the same path and are stored once. spool() and place() split
+that in two, so a caller can record where a file will live before it
+appears there.
+"""
+import hashlib
+import os
+import tempfile
+
+STORE_DIR = "uploads"
+CHUNK_SIZE = 1024 * 1024
+
+
+def path_for(digest, ext=".pdf", store_dir=STORE_DIR):
+    # Two-level fan-out keeps directories small on big projects
+    return os.path.join(store_dir, digest[:2], digest + ext)
+
+
+def spool(fileobj, store_dir=STORE_DIR):
+    # Hash into a temporary file in the store; returns (digest, temp path)
+    os.makedirs(store_dir, exist_ok=True)
+    if hasattr(fileobj, "seek"): fileobj.seek(0)
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=store_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+                out.write(chunk)
+    except Exception:
+        remove(tmp)
+        raise
+    return h.hexdigest(), tmp
+
+
+def place(tmp, digest, ext=".pdf", store_dir=STORE_DIR):
+    dest = path_for(digest, ext, store_dir)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # Atomic, and a no-op in effect if another upload already stored it
+    os.replace(tmp, dest)
+    return dest
+
+
+def store_upload(fileobj, ext=".pdf", store_dir=STORE_DIR):
+    digest, tmp = spool(fileobj, store_dir)
+    try:
+        return digest, place(tmp, digest, ext, store_dir)
+    except Exception:
+        remove(tmp)
+        raise
+
+
+def remove(path):
+    if path and os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,229 @@
+"""Streaming importers for search exports (CSV, RIS, PubMed NBIB, EndNote XML).
+
+Every parser is a generator that yields one Citation at a time, so a 20k
+record export is never held in memory. Field mapping (which CSV column is
+the title, which RIS tag is the abstract...) is decided once per file.
+"""
+import contextlib
+import io
+import os
+import re
+import xml.etree.ElementTree as ET
+from typing import NamedTuple, Optional
+
+import pandas as pd
+
+
+class Citation(NamedTuple):
+    title: str
+    abstract: str = ""
+    authors: str = ""  # "; "-joined, in source order
+    year: Optional[int] = None
+    doi: str = ""
+    pmid: str = ""
+
+    def screening_text(self):
+        return f"{self.title}\n{self.abstract}"
+
+
+SUPPORTED_TYPES = ["csv", "ris", "nbib", "txt", "xml"]
+
+YEAR_RE = re.compile(r"\b(1[89]\d\d|20\d\d)\b")
+
+
+def parse_year(value):
+    m = YEAR_RE.search(value or "")
+    return int(m.group(1)) if m else None
+
+
+@contextlib.contextmanager
+def open_text(source):
+    # Accepts a path or a binary file object (e.g. a Streamlit upload)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding="utf-8-sig", errors="replace") as fh:
+            yield fh
+    else:
+        source.seek(0)
+        fh = io.TextIOWrapper(source, encoding="utf-8-sig", errors="replace")
+        try:
+            yield fh
+        finally:
+            fh.detach()  # don't close the caller's file
+
+
+def detect_format(filename, source=None):
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    if ext in ("csv", "ris", "nbib"): return ext
+    if ext == "xml": return "endnote_xml"
+    if ext == "txt" and source is not None:
+        # PubMed and some RIS exporters both save as .txt: look at the first tag
+        with open_text(source) as fh:
+            for line in fh:
+                if line.strip():
+                    if line.startswith("PMID-"): return "nbib"
+                    if RIS_LINE.match(line.rstrip("\r\n")): return "ris"
+                    break
+        raise ValueError(f"{filename} is neither a PubMed (NBIB) nor an RIS export")
+    raise ValueError(f"Unsupported file type: {filename}")
+
+
+# --- CSV ---
+CSV_COLUMNS = {
+    "title": ['title', 'study title', 'name', 'ti'],
+    "abstract": ['abstract', 'summary', 'text', 'description', 'ab'],
+    "authors": ['authors', 'author', 'au'],
+    "year": ['year', 'publication year', 'py', 'date'],
+    "doi": ['doi'],
+    "pmid": ['pmid', 'pubmed id', 'pubmed_id'],
+}
+
+
+def map_csv_columns(header):
+    mapping = {field: next((k for k in header if k.strip().lower() in names), None)
+               for field, names in CSV_COLUMNS.items()}
+    # Same fallbacks the batch screen has always used
+    if not mapping['title']: mapping['title'] = header[0]
+    if not mapping['abstract'] and len(header) > 1: mapping['abstract'] = header[1]
+    return {field: col for field, col in mapping.items() if col is not None}
+
+
+def iter_csv(source, chunksize=1000):
+    if hasattr(source, "seek"): source.seek(0)
+    header = list(pd.read_csv(source, nrows=0).columns)
+    mapping = map_csv_columns(header)
+    fields = list(mapping)
+    cols = list(dict.fromkeys(mapping.values()))
+
+    if hasattr(source, "seek"): source.seek(0)
+    for chunk in pd.read_csv(source, usecols=cols, chunksize=chunksize, dtype=str, keep_default_na=False):
+        for values in zip(*(chunk[mapping[f]] for f in fields)):
+            row = dict(zip(fields, values))
+            yield Citation(
+                title=row['title'], abstract=row.get('abstract', ""),
+                authors=row.get('authors', ""), year=parse_year(row.get('year')),
+                doi=row.get('doi', "").strip(), pmid=row.get('pmid', "").strip()
+            )
+
+
+# --- RIS ---
+RIS_LINE = re.compile(r"^([A-Z][A-Z0-9])  -(?: (.*))?$")
+RIS_FIELDS = {
+    "TI": "title", "T1": "title", "CT": "title",
+    "AB": "abstract", "N2": "abstract",
+    "AU": "authors", "A1": "authors",
+    "PY": "year", "Y1": "year", "DA": "year",
+    "DO": "doi", "AN": "pmid",
+}
+
+
+def _citation_from_tags(tags):
+    pmid = tags.get('pmid', [""])[0].strip()
+    return Citation(
+        title=" ".join(tags.get('title', [""])[:1]).strip(),
+        abstract=" ".join(tags.get('abstract', [])).strip(),
+        authors="; ".join(a.strip() for a in tags.get('authors', [])),
+        year=parse_year(" ".join(tags.get('year', []))),
+        doi=tags.get('doi', [""])[0].strip(),
+        pmid=pmid if pmid.isdigit() else "",
+    )
+
+
+def iter_ris(source):
+    tags, last = {}, None
+    with open_text(source) as fh:
+        for line in fh:
+            line = line.rstrip("\r\n")
+            m = RIS_LINE.match(line)
+            if not m:
+                # Wrapped value: belongs to the previous tag
+                if last and line.strip(): tags[last][-1] += " " + line.strip()
+                continue
+            tag, value = m.group(1), m.group(2) or ""
+            if tag == "ER":
+                if tags: yield _citation_from_tags(tags)
+                tags, last = {}, None
+            elif tag in RIS_FIELDS:
+                last = RIS_FIELDS[tag]
+                tags.setdefault(last, []).append(value)
+            else:
+                last = None
+    if tags: yield _citation_from_tags(tags)
+
+
+# --- PUBMED NBIB (MEDLINE format) ---
+NBIB_LINE = re.compile(r"^([A-Z]{2,4})\s*- (.*)$")
+NBIB_FIELDS = {"TI": "title", "AB": "abstract", "FAU": "authors", "DP": "year", "PMID": "pmid"}
+
+
+def _citation_from_nbib(tags):
+    # FAU (full names) is preferred, fall back to AU if an export omits it
+    if 'authors' not in tags and 'au' in tags: tags['authors'] = tags['au']
+    doi = next((v.split(" ")[0] for v in tags.get('ids', []) if v.endswith("[doi]")), "")
+    return _citation_from_tags({**tags, 'doi': [doi]})
+
+
+def iter_nbib(source):
+    tags, last = {}, None
+    with open_text(source) as fh:
+        for line in fh:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            if line.startswith("      "):
+                if last: tags[last][-1] += " " + line.strip()
+                continue
+            m = NBIB_LINE.match(line)
+            if not m:
+                continue
+            tag, value = m.group(1), m.group(2)
+            if tag == "PMID" and tags:
+                yield _citation_from_nbib(tags)
+                tags = {}
+            last = NBIB_FIELDS.get(tag) or {"AU": "au", "LID": "ids", "AID": "ids"}.get(tag)
+            if last: tags.setdefault(last, []).append(value)
+    if tags: yield _citation_from_nbib(tags)
+
+
+# --- ENDNOTE XML ---
+ENDNOTE_FIELDS = {
+    "title": "titles/title",
+    "abstract": "abstract",
+    "year": "dates/year",
+    "doi": "electronic-resource-num",
+    "pmid": "accession-num",
+}
+
+
+def _xml_text(elem):
+    return "".join(elem.itertext()).strip() if elem is not None else ""
+
+
+def iter_endnote_xml(source):
+    if hasattr(source, "seek"): source.seek(0)
+    parent = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "records": parent = elem
+            continue
+        if elem.tag != "record":
+            continue
+        vals = {field: _xml_text(elem.find(path)) for field, path in ENDNOTE_FIELDS.items()}
+        yield Citation(
+            title=vals['title'], abstract=vals['abstract'],
+            authors="; ".join(_xml_text(a) for a in elem.iterfind("contributors/authors/author")),
+            year=parse_year(vals['year']), doi=vals['doi'],
+            pmid=vals['pmid'] if vals['pmid'].isdigit() else "",
+        )
+        # Drop the finished record so the tree never grows
+        if parent is not None: parent.remove(elem)
+        else: elem.clear()
+
+
+PARSERS = {"csv": iter_csv, "ris": iter_ris, "nbib": iter_nbib, "endnote_xml": iter_endnote_xml}
+
+
+def iter_records(source, filename=None, fmt=None):
+    filename = filename or getattr(source, "name", None) or str(source)
+    fmt = fmt or detect_format(filename, source)
+    for rec in PARSERS[fmt](source):
+        if rec.title: yield rec
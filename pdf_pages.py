@@ -0,0 +1,128 @@
+"""On-demand page rendering for the PDF viewer.
+
+Pages are rasterised with PyMuPDF only when they are viewed, and kept in a
+size-bounded on-disk cache keyed by file hash, page, zoom and format. A
+repeat view is a file read. The PDFs being viewed are spooled into the same
+cache, and the least recently viewed files are evicted first. Writes are
+counted against a running total, so the cache is only walked when it passes
+the limit, and is then trimmed to a low-water mark.
+"""
+import functools
+import io
+import os
+import threading
+
+import fitz  # PyMuPDF
+
+import file_store
+
+CACHE_DIR = "page_cache"
+PDF_DIR = os.path.join(CACHE_DIR, "pdf")
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+LOW_WATER_BYTES = 192 * 1024 * 1024  # evict down to this, so walks are rare
+DEFAULT_ZOOM = 1.5  # ~108 dpi, readable without being huge
+DEFAULT_FORMAT = "webp"  # about a third of the PNG size for scanned pages
+
+_cache_bytes = None  # running total for this process, set by the first walk
+_cache_lock = threading.Lock()
+
+
+def store_pdf(fileobj):
+    # Viewer-only copy, bounded with the tiles (queued PDFs live in file_store)
+    digest, path = file_store.store_upload(fileobj, store_dir=PDF_DIR)
+    added(os.path.getsize(path), keep=(path,))
+    return digest, path
+
+
+def touch(path):
+    try:
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        pass
+
+
+@functools.lru_cache(maxsize=256)
+def page_count(pdf_path):
+    # Paths come from the content-addressed store, so the path pins the content
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        return doc.page_count
+
+
+def tile_path(digest, page_no, zoom, fmt):
+    return os.path.join(CACHE_DIR, digest[:2], digest, f"{page_no}_{zoom:g}.{fmt}")
+
+
+def encode(pix, fmt):
+    if fmt == "jpg":
+        return pix.tobytes("jpg", jpg_quality=80)
+    if fmt == "webp":
+        # PyMuPDF has no WebP writer; Pillow (a Streamlit dependency) does
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.frombytes("RGB", (pix.width, pix.height), pix.samples).save(buf, "WEBP", quality=80)
+        return buf.getvalue()
+    return pix.tobytes("png")
+
+
+def render_page(pdf_path, digest, page_no, zoom=DEFAULT_ZOOM, fmt=DEFAULT_FORMAT):
+    path = tile_path(digest, page_no, zoom, fmt)
+    if os.path.exists(path):
+        touch(path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    touch(pdf_path)
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        pix = doc[page_no].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    data = encode(pix, fmt)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.part"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    added(len(data), keep=(pdf_path, path))
+    return data
+
+
+def added(nbytes, keep=()):
+    # Other processes share the cache, so the total drifts; each eviction
+    # re-walks and corrects it
+    global _cache_bytes
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, size, _ in cached_files())
+        else:
+            _cache_bytes += nbytes
+        if _cache_bytes > MAX_CACHE_BYTES:
+            _cache_bytes = evict(LOW_WATER_BYTES, keep)
+
+
+def cached_files():
+    files = []
+    for dirpath, _, filenames in os.walk(CACHE_DIR):
+        for fn in filenames:
+            if fn.endswith(".part"): continue  # still being written
+            p = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                continue  # evicted by another process
+            files.append((st.st_mtime, st.st_size, p))
+    return files
+
+
+def evict(max_bytes, keep=()):
+    # Oldest first, never the files in use; returns the remaining size
+    keep = {os.path.normpath(p) for p in keep}
+    files = cached_files()
+    total = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files):
+        if total <= max_bytes: break
+        if os.path.normpath(p) in keep: continue
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
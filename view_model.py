@@ -0,0 +1,72 @@
+"""Precomputed view of a project's results for the Audit Records and Dashboard tabs.
+
+Built once per (project, stage, data version) and then only read, so each
+widget interaction is dictionary lookups rather than DataFrame scans.
+"""
+import pandas as pd
+
+DECISIONS = ["INCLUDE", "EXCLUDE", "UNCLEAR", "PENDING"]
+SOURCE_TYPES = ["Direct Upload", "Mined"]
+CONFIDENCE_BINS = list(range(0, 101, 10))
+
+
+class ResultsView:
+    def __init__(self, results):
+        df = pd.DataFrame(results)
+        self.empty = df.empty
+        self.filter_cache = {}
+        if self.empty:
+            self.df = df
+            return
+
+        # --- FIX: VISUAL RE-INDEXING (1, 2, 3...) ---
+        df = df.sort_values(by='ID').reset_index(drop=True)
+        df['Display_ID'] = range(1, len(df) + 1)
+        df['Decision'] = pd.Categorical(df['Decision'], categories=DECISIONS)
+        df['Source'] = df['Source'].fillna("").astype("category")
+        df['SourceType'] = pd.Categorical(
+            df['Source'].astype(str).str.contains("Mined").map({True: "Mined", False: "Direct Upload"}),
+            categories=SOURCE_TYPES)
+        df['Confidence'] = pd.to_numeric(df['Confidence'], errors="coerce").fillna(0).astype(int)
+        self.df = df
+
+        # ID -> position and ID -> radio label, built once instead of per option
+        ids = df['ID'].tolist()
+        self.row_index = dict(zip(ids, range(len(ids))))
+        self.labels = {i: f"#{n} {str(t)[:30]}..." for i, n, t in zip(ids, df['Display_ID'], df['Title'])}
+        self.sources = ["All"] + sorted(df['Source'].cat.categories.tolist())
+
+        # Ready-made aggregates
+        self.total = len(df)
+        self.decision_counts = df['Decision'].value_counts().to_dict()
+        self.source_decisions = pd.crosstab(df['SourceType'], df['Decision'])
+        self.source_decisions.index = self.source_decisions.index.astype(str)
+        self.source_decisions.columns = self.source_decisions.columns.astype(str)
+        bin_labels = [f"{lo}-{lo + 10}" for lo in CONFIDENCE_BINS[:-1]]
+        self.confidence_hist = (pd.cut(df['Confidence'], bins=CONFIDENCE_BINS, labels=bin_labels, include_lowest=True)
+                                .value_counts(sort=False).rename_axis("Confidence").rename("Studies"))
+        # Prompt caching: share of prompt tokens served from the provider cache
+        tokens = df.reindex(columns=['Prompt_Tokens', 'Cached_Tokens']).apply(pd.to_numeric, errors="coerce")
+        self.prompt_tokens = int(tokens['Prompt_Tokens'].sum())
+        self.cached_tokens = int(tokens['Cached_Tokens'].sum())
+        self.metered_calls = int(tokens['Prompt_Tokens'].notna().sum())
+        self.csv = None
+
+    def row(self, result_id):
+        return self.df.iloc[self.row_index[result_id]]
+
+    def filter_ids(self, decision="All", source="All", max_conf=100):
+        # Memoised per filter combination; the view is rebuilt when data changes
+        key = (decision, source, max_conf)
+        if key not in self.filter_cache:
+            if len(self.filter_cache) >= 64: self.filter_cache.clear()
+            mask = self.df['Confidence'] <= max_conf
+            if decision != "All": mask &= self.df['Decision'] == decision
+            if source != "All": mask &= self.df['Source'] == source
+            self.filter_cache[key] = self.df.loc[mask, 'ID'].tolist()
+        return self.filter_cache[key]
+
+    def to_csv(self):
+        if self.csv is None:
+            self.csv = self.df.drop(columns=['SourceType']).to_csv().encode('utf-8')
+        return self.csv
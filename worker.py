@@ -0,0 +1,140 @@
+"""Background screening worker.
+
+Polls the job queue in the database, screens each claimed study with
+analyze_study and writes the result back. Run as many copies as you like:
+
+    python worker.py --concurrency 4
+"""
+import argparse
+import concurrent.futures
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import database as db
+import file_store
+from audit_engine import analyze_study, read_pdf_text, audit_to_record
+
+# Full texts are the memory-heavy part of a job: cap how many are open and
+# extracted at once, independently of how many API calls are in flight
+pdf_slots = threading.BoundedSemaphore(2)
+
+
+def set_max_open_pdfs(n):
+    global pdf_slots
+    pdf_slots = threading.BoundedSemaphore(n)
+
+
+def screen_and_save(project_id, stage, protocol, name, text, file_path, source, result_id=None,
+                    doi="", pmid="", authors="", year=None):
+    # Shared by the queue worker and the headless CLI
+    if result_id:
+        return rescreen_result(result_id, stage, protocol)
+
+    if file_path:
+        # A missing or unreadable file fails the item rather than being screened
+        with pdf_slots:
+            text = read_pdf_text(file_path, strict_crop=True)
+        if not text.strip():
+            raise ValueError("PDF has no text layer")
+
+    # Same study, same text: the stored screening stands, skip the API call
+    if db.result_exists(project_id, name, stage, doi, pmid, text):
+        return "DUPLICATE"
+
+    res = analyze_study(text, protocol['Pico'], stage=stage, rate_limit_placeholder=False)
+    record = audit_to_record(name, text, res, source, doi, pmid, authors, year)
+    return db.save_new_result(project_id, record, stage, protocol)
+
+
+def rescreen_result(result_id, stage, protocol):
+    row = db.get_result(result_id)
+    if not row:
+        return "MISSING"
+    # Text changes are picked up at import (save_new_result); here only the
+    # criteria can have moved on since the row was screened
+    if row['Protocol_Hash'] == protocol['Hash']:
+        return "FRESH"
+
+    res = analyze_study(row['Abstract'], protocol['Pico'], stage=stage, rate_limit_placeholder=False)
+    record = audit_to_record(row['Title'], row['Abstract'], res, row['Source'])
+    db.update_result_screening(result_id, record, protocol)
+    return result_id
+
+
+def process_item(item):
+    return screen_and_save(item['Project_ID'], item['Stage'], item['Protocol'], item['Name'],
+                           item['Text'], item['File_Path'], item['Source'], item['Result_ID'],
+                           item['DOI'], item['PMID'], item['Authors'], item['Year'])
+
+
+def finish(item, error=None):
+    db.finish_job_item(item['ID'], error)
+    # The spooled PDF is only needed until every study using it is screened
+    if item['File_Path']:
+        db.remove_file_if_unused(item['File_Path'], item['ID'], file_store.remove)
+
+
+def retry_locked(fn, *args, attempts=5, delay=2.0):
+    # A long write elsewhere can outlast SQLite's busy timeout: back off and
+    # try again instead of letting the worker die with items still running
+    for attempt in range(attempts):
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if attempt == attempts - 1: raise
+            print(f"[worker] database busy ({e}), retrying")
+            time.sleep(delay * (attempt + 1))
+
+
+def run_worker(concurrency=4, poll_interval=2.0, once=False, max_open_pdfs=2):
+    set_max_open_pdfs(max_open_pdfs)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    db.init_db()
+    print(f"[worker {worker_id}] started with {concurrency} slot(s)")
+
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # Only claim as many items as we have free slots
+            free = concurrency - len(in_flight)
+            if free > 0:
+                try:
+                    retry_locked(db.requeue_stale_items)
+                    for item in retry_locked(db.claim_job_items, worker_id, free):
+                        in_flight[executor.submit(process_item, item)] = item
+                except sqlite3.OperationalError as e:
+                    print(f"[worker {worker_id}] could not poll the queue: {e}")
+
+            if not in_flight:
+                if once: break
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=poll_interval,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                item = in_flight.pop(f)
+                error = None
+                try:
+                    f.result()
+                except Exception as e:
+                    print(f"[worker {worker_id}] failed {item['Name']}: {e}")
+                    error = str(e)
+                try:
+                    retry_locked(finish, item, error)
+                except sqlite3.OperationalError as e:
+                    # Left 'running'; requeue_stale_items hands it back later
+                    print(f"[worker {worker_id}] could not record {item['Name']}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run queued screening jobs.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Studies screened in parallel by this process.")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between queue polls when idle.")
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty.")
+    parser.add_argument("--max-open-pdfs", type=int, default=2, help="PDFs opened for text extraction at once.")
+    args = parser.parse_args()
+    run_worker(args.concurrency, args.poll_interval, args.once, args.max_open_pdfs)